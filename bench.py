@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Time the bot against a synthetic repository served by fakegithub.py.
+
+For every repository size a cold run (empty database) and a warm run
+(nothing changed since the cold one) are measured, each in a fresh process
+so peak memory belongs to that run alone. Results are written as JSON so
+they can be compared between versions.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import yaml
+try:
+    from urllib2 import urlopen, Request
+except ImportError:
+    from urllib.request import urlopen, Request
+
+from fakegithub import FakeGitHub, make_dataset
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_config(path, database_path, base_config, concurrency, api, api_url):
+    config = {
+        'meta': {
+            'database_path': database_path,
+            'bot_user': 'bot',
+            'concurrency': concurrency,
+            'rate_limit_reserve': 0,
+            # The fake server has no secondary limits to stay clear of
+            'write_interval': 0,
+            'api': api,
+            'api_url': api_url,
+            'graphql_url': api_url + 'graphql',
+        },
+        'defaults': base_config['defaults'],
+        'repositories': [{'owner': 'bench', 'name': 'repo'}],
+    }
+    with open(path, 'w') as handle:
+        yaml.dump(config, handle)
+
+
+def run_once(config_path):
+    """Body of the child process: one bot run, reported on stdout."""
+    import logging
+    import resource
+    import process
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    start = time.time()
+    bot = process.MergerBot(config_path)
+    examined = bot.run()
+    bot.close()
+    wall_time = time.time() - start
+
+    json.dump({
+        'wall_time': round(wall_time, 3),
+        'db_time': round(sum(sample['value'] for sample
+                             in bot.run_metrics.get('sqlite_seconds', [])), 3),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'examined': examined,
+        'metrics': bot.run_metrics,
+    }, sys.stdout)
+
+
+def stats(server, reset=False):
+    if reset:
+        urlopen(Request(server.url + '_reset', data=b'')).read()
+        return
+    return json.loads(urlopen(server.url + '_stats').read().decode('utf-8'))
+
+
+def measure(sizes, comments_per_pr, latency, concurrency, api, base_config):
+    approvers = base_config['defaults']['pr_approvers']
+    results = []
+    for size in sizes:
+        (pulls, comments) = make_dataset(size, comments_per_pr, approvers)
+        server = FakeGitHub(pulls, comments, latency=latency,
+                            rate_limit=10 ** 9, bot_user='bot').start()
+        workdir = tempfile.mkdtemp(prefix='p4-bench-')
+        try:
+            config_path = os.path.join(workdir, 'conf.yaml')
+            write_config(config_path, os.path.join(workdir, 'bench.sqlite'),
+                         base_config, concurrency, api, server.url)
+            for phase in ('cold', 'warm'):
+                stats(server, reset=True)
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__),
+                     '--run-once', config_path],
+                    cwd=HERE)
+                result = json.loads(output.decode('utf-8'))
+                calls = stats(server)['calls']
+                not_modified = calls.get('not_modified', 0)
+                api_calls = sum(calls.values()) - not_modified
+                result.update({
+                    'prs': size,
+                    'comments_per_pr': comments_per_pr,
+                    'latency': latency,
+                    'concurrency': concurrency,
+                    'api': api,
+                    'phase': phase,
+                    'api_calls': api_calls,
+                    'api_calls_by_endpoint': calls,
+                    # Conditional requests answered 304 are free
+                    'rate_limit_used': api_calls - not_modified,
+                })
+                print('%(prs)6d PRs %(phase)s: %(wall_time)7.2fs, %(api_calls)6d API calls, '
+                      '%(db_time)6.2fs in SQLite, %(peak_rss_kb)7d KB peak' % result)
+                results.append(result)
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(workdir)
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-once':
+        run_once(sys.argv[2])
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description='Benchmark the bot against a local fake GitHub')
+    parser.add_argument('--sizes', default='1000,10000,50000',
+                        help='Comma separated numbers of open PRs to benchmark')
+    parser.add_argument('--comments-per-pr', type=int, default=5,
+                        help='Average number of comments on each PR')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake API waits before answering each request')
+    parser.add_argument('--config', default=os.path.join(HERE, 'conf.yaml'),
+                        help='Configuration whose filters and approvers are benchmarked')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--api', default='rest', choices=['rest', 'graphql'],
+                        help='How the bot reads PRs and comments')
+    parser.add_argument('--output', default='bench.json', help='Where to write the results')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as handle:
+        base_config = yaml.load(handle)
+    results = measure([int(size) for size in args.sizes.split(',')],
+                      args.comments_per_pr, args.latency, args.concurrency, args.api,
+                      base_config)
+    with open(args.output, 'w') as handle:
+        json.dump({
+            'revision': revision(),
+            'python': platform.python_version(),
+            'timestamp': int(time.time()),
+            'results': results,
+        }, handle, indent=2, sort_keys=True)
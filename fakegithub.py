@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of the GitHub API the bot uses.
+
+Serves a synthetic repository of any size: paginated ``/pulls`` and
+``/issues/{n}/comments`` listings with ``Link``, ``ETag`` and
+``X-RateLimit-*`` headers, conditional requests, comment creation, the two
+GraphQL queries of ``process.GraphQLClient`` and an optional per-request
+latency. Set ``failures`` to a list of statuses to answer the next
+requests with errors instead. ``GET /_stats`` reports the calls made so far
+and ``POST /_reset`` clears them.
+"""
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import collections
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+    from urllib import urlencode
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl, urlencode
+
+TIMEFMT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def graphql_comment(comment):
+    return {
+        'databaseId': comment['id'],
+        'body': comment['body'],
+        'updatedAt': comment['updated_at'],
+        'author': {'login': comment['user']['login']},
+    }
+
+
+def graphql_connection(items, first, after):
+    """A page of a GraphQL connection; cursors are offsets."""
+    start = int(after) if after else 0
+    end = start + first
+    return {
+        'pageInfo': {'hasNextPage': end < len(items), 'endCursor': str(end)},
+        'nodes': items[start:end],
+    }
+
+
+def make_dataset(prs, comments_per_pr, approvers, seed=0, now=None):
+    """Open PRs and their comments, in the shape GitHub returns them."""
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow() if now is None else now
+    voters = list(approvers) + ['contributor', 'drive-by']
+
+    pulls = []
+    comments = {}
+    for number in range(1, prs + 1):
+        created_at = now - datetime.timedelta(hours=rng.randint(1, 24 * 60))
+        pr_comments = []
+        for index in range(rng.randint(0, 2 * comments_per_pr)):
+            commented_at = created_at + datetime.timedelta(minutes=index + 1)
+            pr_comments.append({
+                'id': number * 1000 + index,
+                'user': {'login': rng.choice(voters)},
+                'body': rng.choice([':+1:', '+1', ':-1:', 'Looks good', 'Needs work']),
+                'created_at': commented_at.strftime(TIMEFMT),
+                'updated_at': commented_at.strftime(TIMEFMT),
+            })
+        updated_at = commented_at if pr_comments else created_at
+
+        pulls.append({
+            'id': 1000000 + number,
+            'number': number,
+            'state': 'open',
+            'title': rng.choice(['Fix #%d', '[PROCEDURES] Change %d',
+                                 '[WIP] Work on %d', 'Feature %d']) % number,
+            'user': {'login': rng.choice(voters)},
+            'body': '',
+            'url': 'https://api.github.com/pulls/%d' % number,
+            'base': {'ref': rng.choice(['dev', 'dev', 'master', 'release_15.07'])},
+            'created_at': created_at.strftime(TIMEFMT),
+            'updated_at': updated_at.strftime(TIMEFMT),
+        })
+        comments[number] = pr_comments
+
+    return pulls, comments
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers are written piecemeal; don't let each wait for an ACK
+    disable_nagle_algorithm = True
+
+    def _send(self, status, data=None, headers=None):
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        for (key, value) in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _paginate(self, items, params):
+        per_page = min(int(params.get('per_page', 30)), 100)
+        page = int(params.get('page', 1))
+        pages = max(1, (len(items) + per_page - 1) // per_page)
+        links = []
+        if page < pages:
+            for (rel, target) in (('next', page + 1), ('last', pages)):
+                query = dict(params, page=target, per_page=per_page)
+                links.append('<%s%s?%s>; rel="%s"' % (
+                    self.server.url, self.path.split('?')[0].lstrip('/'), urlencode(query), rel))
+        return items[(page - 1) * per_page:page * per_page], links
+
+    def _answer(self, endpoint, status, data=None, links=None):
+        """Reply the way GitHub would: conditional, rate limited, slow."""
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.lock:
+            failure = server.failures.pop(0) if server.failures else None
+            if failure is not None:
+                server.calls[endpoint] += 1
+                server.calls['failed'] += 1
+        if failure == 403:
+            # A secondary rate limit
+            return self._send(403, {'message': 'You have triggered an abuse detection mechanism'},
+                              {'Retry-After': '0'})
+        if failure is not None:
+            return self._send(failure, {'message': 'Server Error'})
+
+        body = json.dumps(data)
+        etag = '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest()
+        not_modified = self.command == 'GET' and self.headers.get('If-None-Match') == etag
+        with server.lock:
+            server.calls[endpoint] += 1
+            if not_modified:
+                server.calls['not_modified'] += 1
+            elif server.remaining > 0:
+                server.remaining -= 1
+            else:
+                status, data, links = 403, {'message': 'API rate limit exceeded'}, None
+            headers = {
+                'X-RateLimit-Limit': str(server.rate_limit),
+                'X-RateLimit-Remaining': str(server.remaining),
+                'X-RateLimit-Reset': str(server.reset_at),
+                'ETag': etag,
+            }
+        if links:
+            headers['Link'] = ', '.join(links)
+        if not_modified:
+            return self._send(304, headers=headers)
+        self._send(status, data, headers)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        server = self.server
+
+        if url.path == '/_stats':
+            with server.lock:
+                return self._send(200, {'calls': dict(server.calls),
+                                        'remaining': server.remaining})
+
+        match = re.match(r'^/repos/[^/]+/[^/]+/pulls$', url.path)
+        if match:
+            pulls = [pr for pr in server.pulls
+                     if params.get('state', 'open') == pr['state']
+                     and params.get('base', pr['base']['ref']) == pr['base']['ref']]
+            # Numbers stand in for creation times; newest first by default
+            pulls.sort(key=lambda pr: pr['number'],
+                       reverse=params.get('direction', 'desc') == 'desc')
+            (page, links) = self._paginate(pulls, params)
+            return self._answer('pulls', 200, page, links)
+
+        match = re.match(r'^/repos/[^/]+/[^/]+/pulls/(\d+)$', url.path)
+        if match:
+            number = int(match.group(1))
+            if not 0 < number <= len(server.pulls):
+                return self._answer('pull', 404, {'message': 'Not Found'})
+            return self._answer('pull', 200, server.pulls[number - 1])
+
+        match = re.match(r'^/repos/[^/]+/[^/]+/issues/(\d+)/comments$', url.path)
+        if match:
+            comments = server.comments.get(int(match.group(1)), [])
+            if 'since' in params:
+                comments = [comment for comment in comments
+                            if comment['updated_at'] >= params['since']]
+            (page, links) = self._paginate(comments, params)
+            return self._answer('comments', 200, page, links)
+
+        self._send(404, {'message': 'Not Found'})
+
+    def _graphql(self, request):
+        """Answer the queries by operation name; the query text itself is
+        not parsed."""
+        server = self.server
+        variables = request.get('variables') or {}
+        operation = request.get('operationName')
+        if operation == 'OpenPullRequests':
+            nodes = []
+            for pr in server.pulls:
+                if pr['state'] != 'open' or variables.get('base') not in (None, pr['base']['ref']):
+                    continue
+                comments = server.comments.get(pr['number'], [])
+                nodes.append({
+                    'databaseId': pr['id'],
+                    'number': pr['number'],
+                    'title': pr['title'],
+                    'body': pr['body'],
+                    'url': pr['url'],
+                    'state': pr['state'].upper(),
+                    'createdAt': pr['created_at'],
+                    'updatedAt': pr['updated_at'],
+                    'baseRefName': pr['base']['ref'],
+                    'author': {'login': pr['user']['login']},
+                    'comments': {
+                        'totalCount': len(comments),
+                        'nodes': [graphql_comment(comment) for comment in comments[-100:]],
+                    },
+                })
+            data = {'repository': {'pullRequests': graphql_connection(
+                nodes, min(int(variables.get('first', 30)), 100), variables.get('after'))}}
+        elif operation == 'PullRequestComments':
+            comments = server.comments.get(int(variables['number']), [])
+            data = {'repository': {'pullRequest': {'comments': graphql_connection(
+                [graphql_comment(comment) for comment in comments], 100,
+                variables.get('after'))}}}
+        else:
+            data = None
+        if data is None:
+            return self._answer('graphql', 200, {'errors': [
+                {'message': 'Unknown operation %s' % operation}]})
+        self._answer('graphql', 200, {'data': data})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+
+        if url.path == '/_reset':
+            with server.lock:
+                server.calls.clear()
+                server.remaining = server.rate_limit
+            return self._send(204)
+
+        if url.path == '/graphql':
+            return self._graphql(json.loads(body.decode('utf-8')))
+
+        match = re.match(r'^/repos/[^/]+/[^/]+/issues/(\d+)/comments$', url.path)
+        if match:
+            now = datetime.datetime.utcnow().strftime(TIMEFMT)
+            with server.lock:
+                comments = server.comments.setdefault(int(match.group(1)), [])
+                comment = {
+                    'id': server.next_comment_id,
+                    'user': {'login': server.bot_user},
+                    'body': json.loads(body.decode('utf-8'))['body'],
+                    'created_at': now,
+                    'updated_at': now,
+                }
+                server.next_comment_id += 1
+                comments.append(comment)
+            return self._answer('create_comment', 201, comment)
+
+        self._send(404, {'message': 'Not Found'})
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGitHub(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, pulls, comments, address=('127.0.0.1', 0), latency=0.0,
+                 rate_limit=5000, bot_user='bot'):
+        HTTPServer.__init__(self, address, FakeGitHubHandler)
+        self.pulls = pulls
+        self.comments = comments
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.remaining = rate_limit
+        self.reset_at = int(time.time()) + 3600
+        self.bot_user = bot_user
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.failures = []
+        self.next_comment_id = 10 ** 9
+        self.url = 'http://%s:%s/' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a synthetic GitHub repository')
+    parser.add_argument('--prs', type=int, default=1000, help='Number of open PRs')
+    parser.add_argument('--comments-per-pr', type=int, default=5,
+                        help='Average number of comments on each PR')
+    parser.add_argument('--approvers', default='alice,bob,carol,dave,erin',
+                        help='Comma separated logins whose votes count')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request')
+    parser.add_argument('--rate-limit', type=int, default=5000,
+                        help='Requests allowed before answering 403')
+    parser.add_argument('--bot-user', default='bot', help='Login of created comments')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args()
+
+    (pulls, comments) = make_dataset(args.prs, args.comments_per_pr, args.approvers.split(','))
+    server = FakeGitHub(pulls, comments, address=('127.0.0.1', args.port),
+                        latency=args.latency, rate_limit=args.rate_limit,
+                        bot_user=args.bot_user)
+    # The benchmark reads the address from the first line
+    print(server.url)
+    sys.stdout.flush()
+    server.serve_forever()
@@ -1,88 +1,415 @@
 #!/usr/bin/env python
 import os
 import re
+import signal
+import argparse
+import hmac
+import hashlib
+import operator
+import collections
+import contextlib
+import gzip
+import json
+import socket
+import threading
+import time
+import zlib
 import yaml
-from pygithub3 import Github
+import requests
+from pygithub3.core import json as ghjson
+from pygithub3.services import pull_requests as pr_services
+from pygithub3.services.issues import comments as comment_services
+from pygithub3.resources import pull_requests as pr_resources
+from pygithub3.resources import issues as issue_resources
+from pygithub3.resources import users as user_resources
 import sqlite3
 import datetime
+# strptime imports _strptime lazily, which isn't thread safe on Python 2.
+# pygithub3 parses dates from worker threads and silently keeps the string
+# when that import fails.
+import _strptime  # noqa
 import parsedatetime
 import logging
+from array import array
+from multiprocessing.pool import ThreadPool
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger()
 
-gh = Github(
-    login=os.environ.get('GITHUB_USERNAME', None),
-    password=os.environ.get('GITHUB_PASSWORD', None)
-)
+
+def worker_pool(workers):
+    """A pool of ``workers`` threads, to be shared by every call to
+    :func:`concurrent_map`; None when there is nothing to overlap."""
+    return ThreadPool(workers) if workers > 1 else None
+
+
+def concurrent_map(func, items, pool=None):
+    """``map`` over the threads of ``pool``; plain ``map`` without one, or
+    when there is nothing to overlap."""
+    items = list(items)
+    if pool is None or len(items) <= 1:
+        return [func(item) for item in items]
+    return pool.map(func, items)
+
+
+def background(iterable, maxsize=1):
+    """Iterate over ``iterable`` in a thread of its own, which runs at most
+    ``maxsize`` items ahead of the caller. Exceptions are raised in the
+    caller. Chained, each stage waits on the network or the CPU while the
+    others carry on, and only a few items exist at any time."""
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        # The caller may give up at any time; don't wait for it forever
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as exc:
+            put((False, exc))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (more, item) = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch(when):
+    return (when - EPOCH).total_seconds()
+
+
+def to_timestamp(when):
+    """Whole seconds since the epoch, as times are stored in the database."""
+    return None if when is None else int(to_epoch(when))
+
+
+def from_timestamp(seconds):
+    return None if seconds is None else EPOCH + datetime.timedelta(seconds=seconds)
+
+
+@contextlib.contextmanager
+def transaction(conn, begin='BEGIN'):
+    """Run the block in a transaction of our own. The sqlite3 module commits
+    before every CREATE and ALTER, and can't take the write lock up front as
+    ``BEGIN IMMEDIATE`` does."""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        conn.execute(begin)
+        try:
+            yield
+        except BaseException:
+            conn.execute("""ROLLBACK""")
+            raise
+        conn.execute("""COMMIT""")
+    finally:
+        conn.isolation_level = isolation_level
+
+
+VoteTally = collections.namedtuple('VoteTally', ['plus', 'minus', 'per_user'])
+
+
+class VoteCounter(object):
+    """Counts approvers' :+1: and :-1: votes in one pass over a PR's comments.
+
+    ``per_user`` maps each approver who voted to their ``(plus, minus)``
+    counts.
+    """
+
+    PLUS = re.compile(r'(:\+1:|^\s*\+1\s*$)', re.MULTILINE)
+    MINUS = re.compile(r'(:-1:|^\s*-1\s*$)', re.MULTILINE)
+
+    def __init__(self, approvers):
+        self.approvers = frozenset(approvers)
+
+    def tally(self, comments):
+        plus = minus = 0
+        per_user = {}
+        for page in comments:
+            for comment in page:
+                login = comment.user['login']
+                if login not in self.approvers:
+                    continue
+
+                is_plus = self.PLUS.search(comment.body) is not None
+                is_minus = self.MINUS.search(comment.body) is not None
+                if is_plus or is_minus:
+                    (user_plus, user_minus) = per_user.get(login, (0, 0))
+                    per_user[login] = (user_plus + is_plus, user_minus + is_minus)
+                    plus += is_plus
+                    minus += is_minus
+
+        return VoteTally(plus, minus, per_user)
 
 
 class PullRequestFilter(object):
 
+    # Conditions which only need the PR listing are free and are evaluated
+    # first; the rest need comments fetched from the API.
+    CONDITION_COST = {
+        'state': 0,
+        'title_contains': 0,
+        'to_branch': 0,
+        'older_than': 0,
+        'plus': 1,
+        'minus': 1,
+    }
+
+    # The PullRequest fields each condition reads
+    CONDITION_FIELDS = {
+        'state': ('state', ),
+        'title_contains': ('title', ),
+        'to_branch': ('base', ),
+        'older_than': ('created_at', ),
+        'plus': (),
+        'minus': (),
+    }
+
+    # Numeric conditions (plus, minus) require one of these operators, text
+    # conditions accept only an optional __not.
+    NUMERIC_OPS = {
+        'gt': operator.gt,
+        'ge': operator.ge,
+        'eq': operator.eq,
+        'ne': operator.ne,
+        'lt': operator.lt,
+        'le': operator.le,
+    }
+
+    # How many votes a count is away from satisfying each numeric operator
+    SHORTFALL = {
+        'gt': lambda count, threshold: max(0, threshold + 1 - count),
+        'ge': lambda count, threshold: max(0, threshold - count),
+        'eq': lambda count, threshold: abs(count - threshold),
+        'ne': lambda count, threshold: int(count == threshold),
+        'lt': lambda count, threshold: max(0, count - threshold + 1),
+        'le': lambda count, threshold: max(0, count - threshold),
+    }
+
     def __init__(self, name, conditions, actions, committer_group=None, repo_owner=None,
-                 repo_name=None, bot_user=None):
+                 repo_name=None, bot_user=None, comment_store=None, vote_counter=None,
+                 scheduler=None, metrics=None, ledger=None, client=None, queue=None):
         self.name = name
         self.conditions = conditions
         self.actions = actions
         self.committer_group = [] if committer_group is None else committer_group
+        # Filters built by MergerBot share one counter, and so one tally per PR
+        self.vote_counter = VoteCounter(self.committer_group) if vote_counter is None else vote_counter
         self.repo_owner = repo_owner
         self.repo_name = repo_name
         self.bot_user = bot_user
+        self.comment_store = comment_store
+        self.scheduler = scheduler
+        self.metrics = Metrics() if metrics is None else metrics
+        self.ledger = ledger
+        self.client = RestClient() if client is None else client
+        # With a queue (and a ledger), actions are queued for the
+        # ActionExecutor rather than executed on the spot
+        self.queue = queue
+        self.calendar = parsedatetime.Calendar()
+        self.plan = self.compile()
+        self.fields = self.projection()
+        # Changes whenever something that decides the outcome does
+        self.rule_hash = hashlib.sha1(json.dumps(
+            [self.conditions, self.actions, sorted(self.committer_group)],
+            sort_keys=True, default=str).encode('utf-8')).hexdigest()
         log.info("Registered PullRequestFilter %s", name)
 
     def condition_it(self):
-        for condition_dict in self.conditions:
+        conditions = self.conditions
+        # A single dictionary is accepted when there are no duplicate keys
+        if hasattr(conditions, 'items'):
+            conditions = [conditions]
+        for condition_dict in conditions:
             for key in condition_dict:
                 yield (key, condition_dict[key])
 
-    def apply(self, pr):
-        for (condition_key, condition_value) in self.condition_it():
-            log.debug("[%s] Evaluating %s %s for %s", self.name, condition_key, condition_value, pr)
-            if not self.evaluate(pr, condition_key, condition_value):
-                return
-
-        log.info("Matched %s", pr)
+    def compile(self):
+        """Build the list of ``(key, value, predicate)`` to evaluate, cheapest
+        first. Conditions of the same cost keep their configured order."""
+        plan = []
+        for index, (key, value) in enumerate(self.condition_it()):
+            predicate = self.compile_condition(key, value)
+            cost = self.CONDITION_COST[key.split('__', 1)[0]]
+            plan.append((cost, index, key, value, predicate))
 
-        # If we've made it this far, we pass ALL conditions
-        for action in self.actions:
-            self.execute(pr, action)
+        plan.sort(key=lambda step: step[:2])
+        return [(key, value, predicate) for (cost, index, key, value, predicate) in plan]
 
-        return True
+    def projection(self):
+        """The :attr:`PullRequest.FIELDS` the conditions and actions read."""
+        fields = set()
+        for (key, value, predicate) in self.plan:
+            fields.update(self.CONDITION_FIELDS[key.split('__', 1)[0]])
+        # Comments mention the PR's author
+        if any('comment' in action for action in self.actions):
+            fields.add('user')
+        return fields
 
-    def evaluate(self, pr, condition_key, condition_value):
+    def compile_condition(self, condition_key, condition_value):
         # Some conditions contain an aditional operation we must respect, e.g.
         # __gt or __eq
         if '__' in condition_key:
-            (condition_key, condition_op) = condition_key.split('__', 1)
+            (check_key, condition_op) = condition_key.split('__', 1)
         else:
-            condition_op = None
+            (check_key, condition_op) = (condition_key, None)
 
-        func = getattr(self, 'check_' + condition_key)
-        result = func(pr, cv=condition_value)
+        if check_key not in self.CONDITION_COST:
+            raise ValueError("[%s] Unknown condition %s" % (self.name, condition_key))
+        check = getattr(self, 'check_' + check_key)
+
+        if check_key == 'older_than' and not self.calendar.parseDT(condition_value)[1]:
+            raise ValueError("[%s] Could not parse %s: %s" % (
+                self.name, condition_key, condition_value))
 
         # There are two types of conditions, text and numeric.
         # Numeric conditions are only appropriate for the following types:
         # 1) plus, 2) minus
-        if condition_key in ('plus', 'minus'):
-            if condition_op == 'gt':
-                return int(result) > int(condition_value)
-            elif condition_op == 'ge':
-                return int(result) >= int(condition_value)
-            elif condition_op == 'eq':
-                return int(result) == int(condition_value)
-            elif condition_op == 'ne':
-                return int(result) != int(condition_value)
-            elif condition_op == 'lt':
-                return int(result) < int(condition_value)
-            elif condition_op == 'le':
-                return int(result) <= int(condition_value)
-        # Then there are the next set of tpyes which are mostly text types
+        if check_key in ('plus', 'minus'):
+            if condition_op not in self.NUMERIC_OPS:
+                raise ValueError("[%s] Unknown operator for %s" % (self.name, condition_key))
+            compare = self.NUMERIC_OPS[condition_op]
+            threshold = int(condition_value)
+
+            def predicate(pr):
+                return compare(int(check(pr, cv=condition_value)), threshold)
+        # Then there are the next set of types which are mostly text types.
+        # These have generally already been evaluated by the function, we
+        # just return value/!value
+        elif condition_op == 'not':
+            def predicate(pr):
+                return not check(pr, cv=condition_value)
+        elif condition_op is None:
+            def predicate(pr):
+                return check(pr, cv=condition_value)
         else:
-            # These have generally already been evaluated by the function, we
-            # just return value/!value
-            if condition_op == 'not':
-                return not result
-            else:
-                return result
+            raise ValueError("[%s] Unknown operator for %s" % (self.name, condition_key))
+
+        return predicate
+
+    def query(self):
+        """What the listing of open PRs can be narrowed to without missing
+        any this filter matches: ``{'base': branch}`` when it only matches
+        PRs into one branch, ``{}`` when it can't be narrowed, or None when
+        it matches no open PR at all. The conditions are still checked."""
+        query = {}
+        for (condition_key, condition_value) in self.condition_it():
+            # Only open PRs are listed
+            if condition_key == 'state' and condition_value != 'open':
+                return None
+            if condition_key == 'state__not' and condition_value == 'open':
+                return None
+            if condition_key == 'to_branch':
+                query.setdefault('base', condition_value)
+        return query
+
+    def needs_comments(self, pr):
+        """Whether evaluating this PR will read its comments, i.e. it passes
+        every free condition and a vote condition follows. Without a ledger,
+        actions read them too, to look for earlier bot comments."""
+        for (condition_key, condition_value, predicate) in self.plan:
+            if self.CONDITION_COST[condition_key.split('__', 1)[0]]:
+                return True
+            if not predicate(pr):
+                return False
+        return self.ledger is None and bool(self.actions)
+
+    def shortfall(self, pr, tally):
+        """How many votes ``pr`` is away from matching, going by ``tally``
+        rather than fresh comments. None if a free condition rules it out."""
+        missing = 0
+        for (condition_key, condition_value, predicate) in self.plan:
+            (check_key, condition_op) = (condition_key.split('__', 1) + [None])[:2]
+            if check_key in ('plus', 'minus'):
+                missing += self.SHORTFALL[condition_op](
+                    getattr(tally, check_key), int(condition_value))
+            elif not predicate(pr):
+                return None
+        return missing
+
+    def next_due(self, pr, now):
+        """The next time one of this filter's older_than conditions changes
+        its answer for ``pr``. None if none will, or if another free
+        condition already rules the PR out."""
+        due = []
+        for (condition_key, condition_value, predicate) in self.plan:
+            check_key = condition_key.split('__', 1)[0]
+            if check_key == 'older_than':
+                offset = self.calendar.parseDT(condition_value, now)[0] - now
+                flips_at = pr.created_at - offset
+                if flips_at > now:
+                    due.append(flips_at)
+            elif self.CONDITION_COST[check_key] == 0 and not predicate(pr):
+                return None
+        return min(due) if due else None
+
+    def apply(self, pr):
+        with self.metrics.timed('filter_seconds', filter=self.name):
+            return self._apply(pr)
+
+    def _apply(self, pr):
+        for (condition_key, condition_value, predicate) in self.plan:
+            log.debug("[%s] Evaluating %s %s for %s", self.name, condition_key, condition_value, pr)
+            self.metrics.incr('condition_evaluations', filter=self.name, condition=condition_key)
+            with self.metrics.timed('condition_seconds', filter=self.name,
+                                    condition=condition_key):
+                passed = predicate(pr)
+            if not passed:
+                return
+
+        log.info("Matched %s", pr)
+        self.metrics.incr('filter_matches', filter=self.name)
+
+        # If we've made it this far, we pass ALL conditions
+        for action in self.actions:
+            if self.queue is not None:
+                if self.enqueue(pr, action):
+                    self.metrics.incr('actions_enqueued', filter=self.name,
+                                      action=action['action'])
+            elif self.execute(pr, action):
+                self.metrics.incr('actions_executed', filter=self.name,
+                                  action=action['action'])
+
+        return True
+
+    def evaluate(self, pr, condition_key, condition_value):
+        return self.compile_condition(condition_key, condition_value)(pr)
 
     def check_title_contains(self, pr, cv=None):
         return cv in pr.title
@@ -93,204 +420,2821 @@ class PullRequestFilter(object):
     def _find_in_comments(self, comments, regex):
         for page in comments:
             for resource in page:
-                log.debug('%s, "%s" => %s', regex, resource.body, re.match(regex, resource.body))
                 if re.findall(regex, resource.body, re.MULTILINE):
                     yield resource
 
-    def check_plus(self, pr, cv=None):
+    def _comments(self, pr):
+        # Pages of comments, shared by every check and action on this PR
         if getattr(pr, 'memo_comments', None) is None:
-            pr.memo_comments = gh.issues.comments.list(
-                pr.number, user=self.repo_owner, repo=self.repo_name)
+            pr.memo_comments = [self.comment_store.comments(pr)]
+        return pr.memo_comments
 
-        count = 0
-        for plus1_comment in self._find_in_comments(pr.memo_comments, '(:\+1:|^\s*\+1\s*$)'):
-            if plus1_comment.user.login in self.committer_group:
-                count += 1
+    def _tally(self, pr):
+        memo = getattr(pr, 'memo_tally', None)
+        if memo is None or memo[0] is not self.vote_counter:
+            memo = (self.vote_counter, self.vote_counter.tally(self._comments(pr)))
+            pr.memo_tally = memo
+        return memo[1]
 
-        return count
+    def check_plus(self, pr, cv=None):
+        return self._tally(pr).plus
 
     def check_minus(self, pr, cv=None):
-        if getattr(pr, 'memo_comments', None) is None:
-            pr.memo_comments = gh.issues.comments.list(
-                pr.number, user=self.repo_owner, repo=self.repo_name)
-
-        count = 0
-        for minus1_comment in self._find_in_comments(pr.memo_comments, '(:-1:|^\s*-1\s*$)'):
-            if minus1_comment.user.login in self.committer_group:
-                count += 1
-
-        return count
+        return self._tally(pr).minus
 
     def check_to_branch(self, pr, cv=None):
-        return pr.resource.base['ref'] == cv
+        return pr.base == cv
 
     def check_older_than(self, pr, cv=None):
         created_at = pr.created_at
         current = datetime.datetime.now()
 
-        calendar = parsedatetime.Calendar()
-        current_adjusted, parsed_as = calendar.parseDT(cv, current)
+        current_adjusted, parsed_as = self.calendar.parseDT(cv, current)
 
         return (created_at - current_adjusted).total_seconds() < 0
 
+    @staticmethod
+    def render(pr, action):
+        return action['comment'].format(
+            author='@' + pr.user['login']
+        ).strip().replace('\n', ' ')
+
+    def ledger_key(self, pr, action):
+        """``(owner, repo, pr_id, filter, action_hash)``: editing an action
+        in the configuration makes it a new one."""
+        action_hash = hashlib.sha1(
+            json.dumps(action, sort_keys=True).encode('utf-8')).hexdigest()
+        return (pr.repo_owner, pr.repo_name, pr.id, self.name, action_hash)
+
+    def reconcile(self, pr, comments):
+        """Ledger entries for the comment actions already posted as one of
+        ``comments``."""
+        for action in self.actions:
+            if action['action'] != 'comment':
+                continue
+            comment_text = self.render(pr, action)
+            for comment in comments:
+                if comment_text in comment.body:
+                    yield (self.ledger_key(pr, action), comment.id, comment.updated_at)
+                    break
+
+    def enqueue(self, pr, action):
+        """Queue ``action`` on ``pr`` unless the ledger says it was executed
+        before. Returns whether it was queued."""
+        if not hasattr(ActionExecutor, 'perform_' + action['action']):
+            raise NotImplementedError("Action %s is not available" %
+                                      action['action'])
+        key = self.ledger_key(pr, action)
+        if self.ledger.executed(key):
+            log.info("%s action previously applied, not duplicating", action['action'])
+            return False
+        body = self.render(pr, action) if 'comment' in action else None
+        return self.queue.put(key, pr.number, action, body)
+
     def execute(self, pr, action):
         if action['action'] != 'comment':
             raise NotImplementedError("Action %s is not available" %
                                       action['action'])
 
-        comment_text = action['comment'].format(
-            author='@' + pr.user['login']
-        ).strip().replace('\n', ' ')
+        comment_text = self.render(pr, action)
 
         log.info("Executing action")
 
-        if getattr(pr, '_comments', None) is None:
-            pr._comments = gh.issues.comments.list(
-                pr.number, user=self.repo_owner, repo=self.repo_name)
-
         # Check if we've made this exact comment before, so we don't comment
         # multiple times and annoy people.
-        for possible_bot_comment in self._find_in_comments(
-            pr._comments, comment_text):
-
-            if possible_bot_comment.user.login == self.bot_user:
+        if self.ledger is not None:
+            if self.ledger.executed(self.ledger_key(pr, action)):
                 log.info("Comment action previously applied, not duplicating")
-            else:
-                log.info("Comment action previously applied, not duplicating. However it was applied under a different user. Strange?")
+                return
+        else:
+            for possible_bot_comment in self._find_in_comments(
+                self._comments(pr), re.escape(comment_text)):
 
-            return
+                if possible_bot_comment.user['login'] == self.bot_user:
+                    log.info("Comment action previously applied, not duplicating")
+                else:
+                    log.info("Comment action previously applied, not duplicating. However it was applied under a different user. Strange?")
+
+                return
+
+        if self.scheduler is not None and not self.scheduler.can_write():
+            raise RateLimited("No API budget left to comment on %s" % pr)
 
         # Create the comment
-        gh.issues.comments.create(
+        created = self.client.create_comment(
+            self.repo_owner,
+            self.repo_name,
             pr.number,
             comment_text,
-            user=self.repo_owner,
-            repo=self.repo_name,
         )
+        comment = Comment.from_resource(created)
+        if self.comment_store is not None:
+            self.comment_store.add(pr, comment)
+        if self.ledger is not None:
+            self.ledger.record((self.ledger_key(pr, action), comment.id, comment.updated_at))
 
         return True
 
 
+# One ``{'login': ...}`` per user, shared by all of their PRs and comments
+USERS = {}
+
+
+def user_record(login):
+    return USERS.setdefault(login, {'login': login})
+
+
 class PullRequest(object):
+    """What the filters know about a PR, parsed from a pygithub3 resource or
+    anything with the same attributes, which isn't kept.
+
+    Besides the fields identifying the PR, only the ``fields`` asked for are
+    copied, by default all of :attr:`FIELDS`; the rest are None. ``base`` is
+    the name of the target branch.
+    """
+
+    FIELDS = ('title', 'state', 'base', 'created_at', 'user')
+
+    __slots__ = ('repo_owner', 'repo_name', 'id', 'number', 'updated_at') + FIELDS + (
+        'memo_comments', 'memo_tally')
 
-    def __init__(self, resource):
-        self.resource = resource
+    def __init__(self, resource, repo_owner=None, repo_name=None, fields=None):
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
+        self.id = getattr(resource, 'id', None)
+        self.number = getattr(resource, 'number', None)
+        self.updated_at = getattr(resource, 'updated_at', None)
+        for key in self.FIELDS:
+            setattr(self, key, None)
+        for key in self.FIELDS if fields is None else fields:
+            value = getattr(resource, key, None)
+            if value is not None and key == 'base':
+                value = value['ref']
+            elif value is not None and key == 'user':
+                value = user_record(value['login'])
+            setattr(self, key, value)
+        self.forget()
 
-        for key in ('number', 'title', 'updated_at', 'url', 'user', 'body',
-                    'created_at', 'state', 'id'):
-            setattr(self, key, getattr(self.resource, key, None))
+        log.debug("Built PullRequest #%s %s", self.number, self.title)
 
-        log.info("Built PullRequest #%s %s", self.number, self.title)
-        # 'assignee', 'base', 'body', 'closed_at', 'comments_url',
-        # 'commits_url', 'created_at', 'diff_url', 'head', 'html_url', 'id',
-        # 'issue_url', 'loads', 'locked', 'merge_commit_sha', 'merged_at',
-        # 'milestone', 'number', 'patch_url', 'review_comment_url',
-        # 'review_comments_url', 'state', 'statuses_url', 'title',
-        # 'updated_at', 'url', 'user'
+    def forget(self):
+        """Drop the comments and tally memoized while evaluating the PR."""
+        self.memo_comments = None
+        self.memo_tally = None
 
     def __str__(self):
-        return '<#%s "%s" by @%s (https://github.com/%s/%s/pull/%s)>' % (
-            self.number, self.title, self.user['login'], self.repo_owner,
-            self.repo_name, self.number)
+        return '<#%s%s%s (https://github.com/%s/%s/pull/%s)>' % (
+            self.number, '' if self.title is None else ' "%s"' % self.title,
+            '' if self.user is None else ' by @%s' % self.user['login'],
+            self.repo_owner, self.repo_name, self.number)
 
 
-class MergerBot(object):
+class Comment(object):
 
-    def __init__(self, conf_path):
-        with open(conf_path, 'r') as handle:
-            self.config = yaml.load(handle)
+    __slots__ = ('id', 'user', 'body', 'updated_at')
 
-        self.create_db(database_name=os.path.abspath(
-            self.config['meta']['database_path']))
+    def __init__(self, id, user, body, updated_at):
+        self.id = id
+        self.user = user
+        self.body = body
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_resource(cls, resource):
+        return cls(resource.id, user_record(resource.user.login), resource.body,
+                   resource.updated_at)
+
+    @classmethod
+    def from_payload(cls, data):
+        return cls(data['id'], user_record(data['user']['login']), data['body'],
+                   data['updated_at'])
+
+
+class Page(list):
+    """A page of a listing. Its ``cursor`` continues the listing after it,
+    and is None on the last page."""
+
+    def __init__(self, items=(), cursor=None):
+        super(Page, self).__init__(items)
+        self.cursor = cursor
+
+
+class RestClient(object):
+    """Reads and writes through GitHub's REST API with pygithub3: a listing
+    of open PRs, then a listing of comments for each PR that needs them.
+
+    The pygithub3 services are only built for the first request. They all
+    share the client's single ``requests`` session, so whatever adapter is
+    mounted on it (see :meth:`MergerBot.install_http_cache`) sees every
+    request and keeps its connections alive between them.
+    """
+
+    URL = 'https://api.github.com/'
+
+    def __init__(self, base_url=URL, login=None, password=None):
+        self.base_url = base_url
+        self.session = requests.session()
+        if login and password:
+            self.session.auth = (login, password)
+        self.lock = threading.Lock()
+        self._services = None
+
+    def services(self):
+        """The pull request and issue comment services."""
+        with self.lock:
+            if self._services is None:
+                services = (pr_services.PullRequests(base_url=self.base_url),
+                            comment_services.Comments(base_url=self.base_url))
+                # pygithub3 opens a session per service; use ours instead
+                for service in services:
+                    self.session.params.update(service._client.requester.params)
+                    service._client.requester = self.session
+                self._services = services
+            return self._services
+
+    def sessions(self):
+        """``(requests session, base URL)`` of everything making requests."""
+        return [(self.session, self.base_url)]
+
+    def pull_requests(self, owner, repo, base=None, after=None):
+        """:class:`Page` objects of the repository's open PRs, oldest first,
+        only those into branch ``base`` if given, which pygithub3's ``list``
+        has no parameter for. ``after`` is the cursor of a page to continue
+        after.
+
+        pygithub3's results learn the number of pages from the first one, so
+        they can't start anywhere else; the cursor is the number of the page
+        read and of its last PR, ``"page:number"``. PRs closed since shift the
+        rest onto earlier pages, so a resumed listing reads that page again
+        (usually a free ``304``), steps back while it starts past that PR, and
+        skips the PRs up to it."""
+        (pulls, _) = self.services()
+        request = pulls.make_request('pull_requests.list', user=owner, repo=repo)
+        # New PRs are added at the end, where they can't shift the rest
+        params = {'state': 'open', 'sort': 'created', 'direction': 'asc'}
+        if base is not None:
+            params['base'] = base
+        (page, _, last) = (after or '1').partition(':')
+        (page, last) = (int(page), int(last) if last else None)
+        resuming = last is not None
+        while page:
+            response = pulls._client.get(request, page=page, **params)
+            resources = request.resource.loads(response.content)
+            if resuming and page > 1 and (not resources or resources[0].number > last):
+                page -= 1
+                continue
+            resuming = False
+            cursor = '%s:%s' % (page, resources[-1].number) \
+                if 'next' in response.links else None
+            page = page + 1 if 'next' in response.links else None
+            yield Page([resource for resource in resources
+                        if last is None or resource.number > last], cursor)
+
+    def pull_request(self, owner, repo, number):
+        (pulls, _) = self.services()
+        return pulls.get(number, user=owner, repo=repo)
+
+    def comments(self, number, user=None, repo=None, since=None):
+        """Pages of issue comments, optionally only those updated at or after
+        ``since``, which pygithub3's ``comments.list`` has no parameter for."""
+        (_, comments) = self.services()
+        request = comments.make_request('issues.comments.list', user=user,
+                                        repo=repo, number=number)
+        if since is None:
+            return comments._get_result(request)
+        return comments._get_result(request, since=since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def create_comment(self, owner, repo, number, body):
+        (_, comments) = self.services()
+        return comments.create(number, body, user=owner, repo=repo)
+
+
+class GraphQLError(Exception):
+    """GitHub's GraphQL API answered with errors."""
+
+
+class GraphQLClient(RestClient):
+    """Reads through GitHub's GraphQL API. Open PRs come ``page_size`` at a
+    time, each with its latest 100 comments, so most PRs need no comment
+    request of their own. Writes still go through REST.
+
+    Results are built into the same pygithub3 resources the REST API
+    produces. A PR whose comments were all included carries them as
+    ``listed_comments``.
+    """
+
+    URL = 'https://api.github.com/graphql'
+
+    PULL_REQUESTS = """
+        query OpenPullRequests($owner: String!, $name: String!, $base: String, $first: Int!,
+                               $after: String) {
+          repository(owner: $owner, name: $name) {
+            pullRequests(states: OPEN, baseRefName: $base, first: $first, after: $after) {
+              pageInfo { hasNextPage endCursor }
+              nodes {
+                databaseId number title body url state createdAt updatedAt baseRefName
+                author { login }
+                comments(last: 100) {
+                  totalCount
+                  nodes { databaseId body updatedAt author { login } }
+                }
+              }
+            }
+          }
+        }
+    """
+
+    COMMENTS = """
+        query PullRequestComments($owner: String!, $name: String!, $number: Int!,
+                                  $after: String) {
+          repository(owner: $owner, name: $name) {
+            pullRequest(number: $number) {
+              comments(first: 100, after: $after) {
+                pageInfo { hasNextPage endCursor }
+                nodes { databaseId body updatedAt author { login } }
+              }
+            }
+          }
+        }
+    """
+
+    def __init__(self, url=URL, page_size=50, base_url=RestClient.URL, login=None,
+                 password=None):
+        super(GraphQLClient, self).__init__(base_url, login=login, password=password)
+        self.url = url
+        self.page_size = page_size
+
+    def sessions(self):
+        return super(GraphQLClient, self).sessions() + [(self.session, self.url)]
+
+    def query(self, operation, query, **variables):
+        response = self.session.post(self.url, data=json.dumps({
+            'operationName': operation,
+            'query': query,
+            'variables': variables,
+        }))
+        response.raise_for_status()
+        result = ghjson.loads(response.text)
+        errors = result.get('errors')
+        if errors:
+            if any(error.get('type') == 'RATE_LIMITED' for error in errors):
+                raise RateLimited("GraphQL %s was rate limited" % operation)
+            raise GraphQLError("; ".join(error.get('message', '') for error in errors))
+        return result['data']
+
+    @staticmethod
+    def _login(author):
+        # Deleted accounts have no author
+        return author['login'] if author else 'ghost'
+
+    @staticmethod
+    def _time(value):
+        # pygithub3 leaves timestamps it couldn't parse as strings
+        if isinstance(value, datetime.datetime):
+            return value
+        return datetime.datetime.strptime(value, ghjson.GITHUB_DATE_FORMAT)
+
+    def _comment(self, node):
+        return issue_resources.Comment({
+            'id': node['databaseId'],
+            'user': user_resources.User({'login': self._login(node['author'])}),
+            'body': node['body'],
+            'updated_at': self._time(node['updatedAt']),
+        })
+
+    def _pull_request(self, node):
+        resource = pr_resources.PullRequest({
+            'id': node['databaseId'],
+            'number': node['number'],
+            'title': node['title'],
+            'body': node['body'],
+            'url': node['url'],
+            'state': node['state'].lower(),
+            'created_at': node['createdAt'],
+            'updated_at': node['updatedAt'],
+            'user': {'login': self._login(node['author'])},
+            'base': {'ref': node['baseRefName']},
+        })
+        comments = node['comments']
+        if comments['totalCount'] <= len(comments['nodes']):
+            resource.listed_comments = [self._comment(comment) for comment in comments['nodes']]
+        return resource
+
+    def pull_requests(self, owner, repo, base=None, after=None):
+        while True:
+            data = self.query('OpenPullRequests', self.PULL_REQUESTS, owner=owner, name=repo,
+                              base=base, first=self.page_size, after=after)
+            connection = data['repository']['pullRequests']
+            after = connection['pageInfo']['endCursor'] \
+                if connection['pageInfo']['hasNextPage'] else None
+            yield Page([self._pull_request(node) for node in connection['nodes']], after)
+            if after is None:
+                return
+
+    def comments(self, number, user=None, repo=None, since=None):
+        after = None
+        while True:
+            data = self.query('PullRequestComments', self.COMMENTS, owner=user, name=repo,
+                              number=number, after=after)
+            connection = data['repository']['pullRequest']['comments']
+            yield [self._comment(node) for node in connection['nodes']
+                   if since is None or self._time(node['updatedAt']) >= since]
+            if not connection['pageInfo']['hasNextPage']:
+                return
+            after = connection['pageInfo']['endCursor']
+
+
+def make_client(meta):
+    """The API client chosen by ``meta.api``: ``rest`` (the default) or
+    ``graphql``. REST requests go to ``meta.api_url``."""
+    api = meta.get('api', 'rest')
+    credentials = {
+        'base_url': meta.get('api_url', RestClient.URL),
+        'login': os.environ.get('GITHUB_USERNAME', None),
+        'password': os.environ.get('GITHUB_PASSWORD', None),
+    }
+    if api == 'rest':
+        return RestClient(**credentials)
+    if api == 'graphql':
+        return GraphQLClient(
+            url=meta.get('graphql_url', GraphQLClient.URL),
+            page_size=int(meta.get('graphql_page_size', 50)),
+            **credentials)
+    raise ValueError("Unknown api %s, expected rest or graphql" % api)
+
+
+class StateStore(object):
+    """In-memory view of the ``pr_data`` table, keyed by
+    ``(owner, repo, pr_id)``.
+
+    Every row is loaded with a single query up front. Changes made during a
+    run only mark rows as dirty; :meth:`flush` writes all of them back in one
+    transaction. Besides ``updated_at`` each row has a ``next_due`` time at
+    which a time-based condition may change, see :meth:`due`.
+    """
+
+    def __init__(self, conn, lock=None):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+        self.rows = {}
+        self.next_due = {}
+        self.dirty = set()
+        self.load()
+
+    def load(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT owner, repo, pr_id, updated_at, next_due FROM pr_data""")
+            self.rows = {}
+            self.next_due = {}
+            for (owner, repo, pr_id, updated_at, next_due) in cursor.fetchall():
+                self.rows[(owner, repo, pr_id)] = from_timestamp(updated_at)
+                self.next_due[(owner, repo, pr_id)] = from_timestamp(next_due)
+            self.dirty.clear()
+
+    def get(self, key):
+        return self.rows.get(key)
+
+    def set(self, key, updated_at, next_due=None):
+        with self.lock:
+            if (self.rows.get(key), self.next_due.get(key)) != (updated_at, next_due):
+                self.rows[key] = updated_at
+                self.next_due[key] = next_due
+                self.dirty.add(key)
+
+    def due(self, owner, repo, now):
+        """IDs of the repository's PRs whose ``next_due`` has passed."""
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT pr_id FROM pr_data WHERE owner = ? AND repo = ? AND next_due <= ?""",
+                (owner, repo, to_timestamp(now)))
+            return set(pr_id for (pr_id, ) in cursor.fetchall())
+
+    def prune(self, owner, repo, open_ids):
+        """Forget the repository's PRs which aren't among ``open_ids``, taken
+        from a complete listing of its open PRs. Returns the IDs dropped."""
+        with self.lock:
+            closed = [key for key in self.rows
+                      if key[:2] == (owner, repo) and key[2] not in open_ids]
+            if not closed:
+                return []
+            for key in closed:
+                del self.rows[key]
+                del self.next_due[key]
+                self.dirty.discard(key)
+            with self.conn:
+                self.conn.executemany(
+                    """DELETE FROM pr_data WHERE owner = ? AND repo = ? AND pr_id = ?""", closed)
+        return [key[2] for key in closed]
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return 0
+
+            rows = [key + (to_timestamp(self.rows[key]), to_timestamp(self.next_due[key]))
+                    for key in self.dirty]
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT OR REPLACE INTO pr_data(owner, repo, pr_id, updated_at, next_due)
+                    VALUES (?, ?, ?, ?, ?)""", rows)
+            self.dirty.clear()
+        return len(rows)
+
+
+class FilterResults(object):
+    """Whether each filter matched each PR, in the ``filter_results`` table,
+    keyed by ``(owner, repo, pr_id, filter)``.
+
+    A result stands while the PR's ``updated_at`` and the filter's
+    :attr:`PullRequestFilter.rule_hash` are the ones it was recorded with,
+    and until its ``valid_until``, when a time-based condition may change
+    it. Like :class:`StateStore`, rows are loaded up front and written back
+    by :meth:`flush`.
+    """
+
+    def __init__(self, conn, lock=None):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+        self.rows = {}
+        self.dirty = set()
+        self.load()
+
+    def load(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT owner, repo, pr_id, filter, rule_hash, updated_at,
+                           valid_until, matched FROM filter_results""")
+            self.rows = dict(
+                ((owner, repo, pr_id, name),
+                 (rule_hash, from_timestamp(updated_at), from_timestamp(valid_until),
+                  bool(matched)))
+                for (owner, repo, pr_id, name, rule_hash, updated_at, valid_until, matched)
+                in cursor.fetchall()
+            )
+            self.dirty.clear()
+
+    def get(self, key, updated_at, pr_filter, now):
+        """Whether ``pr_filter`` matched the PR ``key`` as of ``updated_at``,
+        or None when that isn't known."""
+        row = self.rows.get(key + (pr_filter.name, ))
+        if row is None:
+            return None
+        (rule_hash, recorded_at, valid_until, matched) = row
+        if (rule_hash, recorded_at) != (pr_filter.rule_hash, updated_at):
+            return None
+        if valid_until is not None and valid_until <= now:
+            return None
+        return matched
+
+    def set(self, key, updated_at, pr_filter, matched, valid_until=None):
+        key = key + (pr_filter.name, )
+        with self.lock:
+            self.rows[key] = (pr_filter.rule_hash, updated_at, valid_until, bool(matched))
+            self.dirty.add(key)
+
+    def prune(self, owner, repo, pr_ids):
+        """Drop the results of the repository's PRs in ``pr_ids``."""
+        pr_ids = set(pr_ids)
+        with self.lock:
+            for key in [key for key in self.rows
+                        if key[:2] == (owner, repo) and key[2] in pr_ids]:
+                del self.rows[key]
+                self.dirty.discard(key)
+            with self.conn:
+                self.conn.executemany(
+                    """DELETE FROM filter_results WHERE owner = ? AND repo = ? AND pr_id = ?""",
+                    [(owner, repo, pr_id) for pr_id in pr_ids])
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return 0
+
+            rows = []
+            for key in self.dirty:
+                (rule_hash, updated_at, valid_until, matched) = self.rows[key]
+                rows.append(key + (rule_hash, to_timestamp(updated_at),
+                                   to_timestamp(valid_until), int(matched)))
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT OR REPLACE INTO filter_results(owner, repo, pr_id, filter,
+                    rule_hash, updated_at, valid_until, matched)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            self.dirty.clear()
+        return len(rows)
+
+
+class CommentStore(object):
+    """Comments of every PR we've looked at, kept in the bot's database.
+
+    The first time a PR's comments are needed in a run, all of them are
+    listed and replace those stored, so edited comments are updated and
+    deleted ones forgotten. Comments are only needed for PRs which changed;
+    listings which didn't change are answered from the HTTP cache.
+
+    PRs are keyed by ``(owner, repo, pr_id)``. Repositories are processed in
+    parallel, so the store and the database are only touched while holding
+    ``lock``.
+    """
+
+    def __init__(self, conn, fetch=None, lock=None):
+        self.conn = conn
+        self.fetch = RestClient().comments if fetch is None else fetch
+        self.lock = threading.RLock() if lock is None else lock
+        self.memo = {}
+        self.pending = {}
+        # Comments deleted on GitHub, by ID, with their PR's key
+        self.removed = {}
+
+    def load(self):
+        # Other workers may have synced comments since; read them again
+        with self.lock:
+            self.memo.clear()
+
+    @staticmethod
+    def key(pr):
+        return (pr.repo_owner, pr.repo_name, pr.id)
+
+    def start_run(self):
+        # Comments are synced at most once per run; forget what was synced
+        # so a long-running bot asks again next time.
+        with self.lock:
+            self.memo.clear()
+
+    def _load(self, key):
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """SELECT comment_id, login, body, updated_at FROM pr_comments
+            WHERE owner = ? AND repo = ? AND pr_id = ?""", key)
+        return dict(
+            (comment_id, Comment(comment_id, user_record(login), body,
+                                 from_timestamp(updated_at)))
+            for (comment_id, login, body, updated_at) in cursor.fetchall()
+        )
+
+    def _fetch(self, pr):
+        pages = self.fetch(pr.number, user=pr.repo_owner, repo=pr.repo_name)
+        return [Comment.from_resource(resource) for page in pages for resource in page]
+
+    def stored(self, pr):
+        """Comments already known for ``pr``, without asking GitHub."""
+        key = self.key(pr)
+        with self.lock:
+            if key in self.memo:
+                comments = self.memo[key]
+            else:
+                comments = self._load(key)
+                # Changes not flushed yet, e.g. from webhooks
+                for (comment_id, removed_key) in self.removed.items():
+                    if removed_key == key:
+                        comments.pop(comment_id, None)
+                for (pending_key, comment) in self.pending.values():
+                    if pending_key == key:
+                        comments[comment.id] = comment
+        return sorted(comments.values(), key=lambda comment: comment.id)
+
+    def _sync(self, pr, comments):
+        # ``comments`` is every comment the PR has
+        key = self.key(pr)
+        with self.lock:
+            stored = self._load(key)
+            self.memo[key] = {}
+            for comment in comments:
+                self.memo[key][comment.id] = comment
+                known = stored.pop(comment.id, None)
+                if known is None or (known.body, known.updated_at) != \
+                        (comment.body, comment.updated_at):
+                    self.pending[comment.id] = (key, comment)
+            for comment_id in stored:
+                self.removed[comment_id] = key
+
+    def prefetch(self, prs, pool=None):
+        """Sync the comments of several PRs, with a request in flight per
+        thread of ``pool``. Only the network requests run in the pool;
+        results are merged into the store from the calling thread."""
+        with self.lock:
+            prs = [pr for pr in prs if self.key(pr) not in self.memo]
+        fetched = concurrent_map(self._fetch, prs, pool)
+        for (pr, comments) in zip(prs, fetched):
+            self._sync(pr, comments)
+
+    def preload(self, pr, resources):
+        """Sync ``pr`` with the complete list of its comments, already at
+        hand, e.g. from a GraphQL listing."""
+        self._sync(pr, [Comment.from_resource(resource) for resource in resources])
+
+    def comments(self, pr):
+        key = self.key(pr)
+        with self.lock:
+            known = key in self.memo
+        if not known:
+            self._sync(pr, self._fetch(pr))
+
+        with self.lock:
+            return sorted(self.memo[key].values(), key=lambda comment: comment.id)
+
+    def ingest(self, pr, comment):
+        """Store a comment delivered by a webhook."""
+        self.add(pr, comment)
+
+    def remove(self, pr, comment_id):
+        """Forget a comment whose deletion a webhook delivered."""
+        key = self.key(pr)
+        with self.lock:
+            self.memo.get(key, {}).pop(comment_id, None)
+            self.pending.pop(comment_id, None)
+            self.removed[comment_id] = key
+
+    def add(self, pr, comment):
+        # Only comments listed in full this run are memoised; those stored
+        # may be missing some, so the PR's comments are still listed later.
+        key = self.key(pr)
+        with self.lock:
+            if key in self.memo:
+                self.memo[key][comment.id] = comment
+            self.pending[comment.id] = (key, comment)
+            self.removed.pop(comment.id, None)
+
+    def release(self, prs):
+        """Forget the comments of ``prs`` once they have been evaluated and
+        flushed, so a run holds those of a few pages of PRs at most."""
+        with self.lock:
+            for pr in prs:
+                self.memo.pop(self.key(pr), None)
+
+    def prune(self, owner, repo, pr_ids):
+        """Drop the comments of the repository's PRs in ``pr_ids``."""
+        pr_ids = set(pr_ids)
+        keys = [(owner, repo, pr_id) for pr_id in pr_ids]
+        with self.lock:
+            for key in keys:
+                self.memo.pop(key, None)
+            for (comment_id, (key, comment)) in list(self.pending.items()):
+                if key[:2] == (owner, repo) and key[2] in pr_ids:
+                    del self.pending[comment_id]
+            with self.conn:
+                self.conn.executemany(
+                    """DELETE FROM pr_comments WHERE owner = ? AND repo = ? AND pr_id = ?""",
+                    keys)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending and not self.removed:
+                return 0
+
+            rows = [(comment.id, ) + key + (comment.user['login'], comment.body,
+                                            to_timestamp(comment.updated_at))
+                    for (key, comment) in self.pending.values()]
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT OR REPLACE INTO pr_comments(comment_id, owner, repo, pr_id,
+                    login, body, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+                self.conn.executemany(
+                    """DELETE FROM pr_comments WHERE comment_id = ?""",
+                    [(comment_id, ) for comment_id in self.removed])
+            self.pending.clear()
+            self.removed.clear()
+        return len(rows)
+
+
+class ListingCursors(object):
+    """How far each listing of open PRs got, in the ``listing_cursors``
+    table, keyed by ``(owner, repo, listing)``.
+
+    Until a listing has been read to the end once, the cursor after each
+    page is recorded as soon as the page's PRs were evaluated and stored.
+    A backfill which crashed or ran out of budget continues from there.
+    Listings which completed before always start from the beginning. Like
+    the ledger, changes are committed straight away.
+    """
+
+    def __init__(self, conn, lock=None):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+
+    def resume(self, owner, repo, listing):
+        """``(backfill, cursor)``: whether the listing never completed, and
+        where it stopped if so, None for the beginning."""
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT cursor, completed_at FROM listing_cursors
+                WHERE owner = ? AND repo = ? AND listing = ?""", (owner, repo, listing))
+            row = cursor.fetchone()
+        if row is None:
+            return (True, None)
+        return (not row[1], row[0])
+
+    def advance(self, owner, repo, listing, cursor, now=None):
+        """Record that everything before ``cursor`` was evaluated. A None
+        ``cursor`` completes the listing."""
+        now = int(time.time()) if now is None else now
+        with self.lock, self.conn:
+            self.conn.execute(
+                """INSERT OR REPLACE INTO listing_cursors(owner, repo, listing, cursor,
+                completed_at) VALUES (?, ?, ?, ?, ?)""",
+                (owner, repo, listing, cursor, None if cursor is not None else now))
+
+
+class ActionLedger(object):
+    """Actions already executed, in the ``action_ledger`` table, keyed by
+    ``(owner, repo, pr_id, filter, action_hash)``.
+
+    Checking for an earlier execution is one primary key lookup. Unlike the
+    other stores, entries are committed as soon as they are recorded: losing
+    one would repeat a comment.
+    """
+
+    def __init__(self, conn, lock=None):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+
+    def executed(self, key):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT 1 FROM action_ledger WHERE owner = ? AND repo = ? AND pr_id = ?
+                AND filter = ? AND action_hash = ?""", key)
+            return cursor.fetchone() is not None
+
+    def record(self, *entries):
+        """Store ``(key, comment_id, executed_at)`` entries. Returns how many
+        were new."""
+        rows = [key + (comment_id, to_timestamp(executed_at))
+                for (key, comment_id, executed_at) in entries]
+        with self.lock:
+            before = self.conn.total_changes
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT OR IGNORE INTO action_ledger(owner, repo, pr_id, filter,
+                    action_hash, comment_id, executed_at) VALUES (?, ?, ?, ?, ?, ?, ?)""", rows)
+            return self.conn.total_changes - before
+
+
+class ActionQueue(object):
+    """Actions waiting to be executed, in the ``action_queue`` table, keyed
+    like the :class:`ActionLedger` by ``(owner, repo, pr_id, filter,
+    action_hash)``, so an action is never queued twice.
+
+    An item is due from its ``not_before`` time. Taking one pushes that
+    back by ``claim_seconds``, so no other worker takes it meanwhile, and
+    counts an attempt; after ``max_attempts`` it is given up on. Like the
+    ledger, changes are committed straight away.
+    """
+
+    def __init__(self, conn, lock=None, claim_seconds=300, max_attempts=5):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+        self.claim_seconds = claim_seconds
+        self.max_attempts = max_attempts
+
+    def put(self, key, number, action, body, now=None):
+        """Queue ``action`` on PR ``number``, or give an item which was given
+        up on another go. Returns whether anything changed."""
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            before = self.conn.total_changes
+            with self.conn:
+                self.conn.execute(
+                    """INSERT OR IGNORE INTO action_queue(owner, repo, pr_id, filter,
+                    action_hash, number, action, body, attempts, not_before, queued_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, ?)""",
+                    key + (number, json.dumps(action, sort_keys=True), body, now, now))
+                self.conn.execute(
+                    """UPDATE action_queue SET attempts = 0, not_before = ?
+                    WHERE owner = ? AND repo = ? AND pr_id = ? AND filter = ?
+                    AND action_hash = ? AND attempts >= ?""",
+                    (now, ) + key + (self.max_attempts, ))
+            return self.conn.total_changes > before
+
+    def take(self, now=None):
+        """Claim the item due longest ago. Returns ``(key, number, action,
+        body, attempts, queued_at)`` with ``attempts`` counting this one,
+        or None when nothing is due."""
+        now = int(time.time()) if now is None else now
+        with self.lock, transaction(self.conn, """BEGIN IMMEDIATE"""):
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT owner, repo, pr_id, filter, action_hash, number, action, body,
+                attempts, queued_at FROM action_queue WHERE not_before <= ? AND attempts < ?
+                ORDER BY not_before LIMIT 1""", (now, self.max_attempts))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            key = tuple(row[:5])
+            cursor.execute(
+                """UPDATE action_queue SET attempts = attempts + 1, not_before = ?
+                WHERE owner = ? AND repo = ? AND pr_id = ? AND filter = ? AND action_hash = ?""",
+                (now + self.claim_seconds, ) + key)
+        return (key, row[5], json.loads(row[6]), row[7], row[8] + 1, row[9])
+
+    def retry(self, key, not_before, error=None, attempted=True):
+        """Put a taken item back, due at ``not_before``. Without an
+        ``attempted`` request, it doesn't count as an attempt."""
+        with self.lock, self.conn:
+            self.conn.execute(
+                """UPDATE action_queue SET not_before = ?, last_error = ?,
+                attempts = attempts - ? WHERE owner = ? AND repo = ? AND pr_id = ?
+                AND filter = ? AND action_hash = ?""",
+                (not_before, error, 0 if attempted else 1) + key)
+
+    def done(self, key):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """DELETE FROM action_queue WHERE owner = ? AND repo = ? AND pr_id = ?
+                AND filter = ? AND action_hash = ?""", key)
+
+    def counts(self):
+        """``(waiting, failed)``: items still to be tried, and those which
+        were given up on."""
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT SUM(attempts < ?), SUM(attempts >= ?) FROM action_queue""",
+                (self.max_attempts, self.max_attempts))
+            (waiting, failed) = cursor.fetchone()
+        return (waiting or 0, failed or 0)
+
+
+class ActionExecutor(object):
+    """Drains the :class:`ActionQueue`, at most one write every
+    ``write_interval`` seconds, so a burst of matches doesn't trip GitHub's
+    secondary limits on creating content.
+
+    A failed action is tried again ``backoff`` seconds later, doubling each
+    time, up to the queue's ``max_attempts``. The ledger key of every item is its
+    idempotency key: an action already in the ledger is dropped, and
+    before trying again after an attempt whose outcome isn't known, the
+    PR's comments are searched for the one it would have posted.
+
+    Each action type has a ``perform_<action>`` method, e.g. a ``merge``
+    action would be ``perform_merge``.
+    """
+
+    def __init__(self, queue, client, ledger, scheduler=None, metrics=None, bot_user=None,
+                 write_interval=1.0, backoff=60):
+        self.queue = queue
+        self.client = client
+        self.ledger = ledger
+        self.scheduler = scheduler
+        self.metrics = Metrics() if metrics is None else metrics
+        self.bot_user = bot_user
+        self.write_interval = write_interval
+        self.backoff = backoff
+        self.last_write = 0
+
+    def _wait_for_turn(self):
+        wait = self.last_write + self.write_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_write = time.time()
+
+    def drain(self, stopping=None):
+        """Execute every due action. Returns how many were executed."""
+        executed = 0
+        while stopping is None or not stopping.is_set():
+            if self.scheduler is not None and not self.scheduler.can_write():
+                log.warning("No API budget left to execute queued actions")
+                break
+            item = self.queue.take()
+            if item is None:
+                break
+            (key, number, action, body, attempts, queued_at) = item
+            if self.ledger.executed(key):
+                self.queue.done(key)
+                continue
+            try:
+                self.execute(key, number, action, body, attempts, queued_at)
+            except RateLimited as exc:
+                log.warning("Stopping queued actions: %s", exc)
+                self.queue.retry(key, int(time.time()), attempted=False)
+                break
+            except Exception as exc:
+                retry_at = int(time.time() + self.backoff * 2 ** (attempts - 1))
+                log.warning("%s on %s/%s#%s failed (attempt %s of %s): %s", action['action'],
+                            key[0], key[1], number, attempts, self.queue.max_attempts, exc)
+                self.metrics.incr('actions_failed', filter=key[3], action=action['action'])
+                self.queue.retry(key, retry_at, error=str(exc))
+                if attempts >= self.queue.max_attempts:
+                    log.error("Giving up on %s on %s/%s#%s until it changes",
+                              action['action'], key[0], key[1], number)
+                continue
+            self.queue.done(key)
+            self.metrics.incr('actions_executed', filter=key[3], action=action['action'])
+            executed += 1
+        (waiting, failed) = self.queue.counts()
+        self.metrics.set('actions_queued', waiting)
+        self.metrics.set('actions_given_up', failed)
+        return executed
+
+    def execute(self, key, number, action, body, attempts, queued_at):
+        perform = getattr(self, 'perform_' + action['action'])
+        if attempts > 1 and self.already_performed(key, number, action, body, queued_at):
+            return
+        self._wait_for_turn()
+        perform(key, number, action, body)
+
+    def already_performed(self, key, number, action, body, queued_at):
+        """Whether an earlier attempt went through after all, in which case
+        it is recorded in the ledger."""
+        if action['action'] != 'comment':
+            return False
+        for page in self.client.comments(number, user=key[0], repo=key[1],
+                                         since=from_timestamp(queued_at)):
+            for comment in map(Comment.from_resource, page):
+                if comment.user['login'] == self.bot_user and body in comment.body:
+                    self.ledger.record((key, comment.id, comment.updated_at))
+                    return True
+        return False
+
+    def perform_comment(self, key, number, action, body):
+        created = self.client.create_comment(key[0], key[1], number, body)
+        self.ledger.record((key, created.id, created.updated_at))
+
+
+class LeaseLost(Exception):
+    """Another worker has taken over a shard this one was working on."""
+
+
+class LeaseStore(object):
+    """Shards of the work, leased to one worker at a time through the
+    ``leases`` table of the database every worker shares.
+
+    A lease lasts ``duration`` seconds and is renewed while the shard is
+    worked on, see :meth:`hold`. A crashed worker's leases run out, and its
+    shards are claimed by whichever worker looks next. Leases are taken in
+    ``BEGIN IMMEDIATE`` transactions, so two workers never hold the same
+    shard. Each row also records when its shard was last swept.
+    """
+
+    def __init__(self, conn, worker, shards, duration=300, lock=None):
+        self.conn = conn
+        self.worker = worker
+        self.shards = shards
+        self.duration = duration
+        self.lock = threading.RLock() if lock is None else lock
+        # When each lease this worker holds runs out
+        self.expires = {}
+        with self.lock, self.conn:
+            self.conn.executemany(
+                """INSERT OR IGNORE INTO leases(shard, worker, expires_at, swept_at)
+                VALUES (?, NULL, 0, 0)""", [(shard, ) for shard in range(shards)])
+
+    def _take(self, cursor, shard, now):
+        cursor.execute(
+            """UPDATE leases SET worker = ?, expires_at = ? WHERE shard = ?""",
+            (self.worker, now + self.duration, shard))
+        self.expires[shard] = now + self.duration
+        return shard
+
+    def acquire(self, shard, now=None):
+        """Lease ``shard`` unless another worker holds it. Returns whether it
+        was leased."""
+        now = int(time.time()) if now is None else now
+        with self.lock, transaction(self.conn, """BEGIN IMMEDIATE"""):
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT 1 FROM leases WHERE shard = ?
+                AND (worker IS NULL OR worker = ? OR expires_at <= ?)""",
+                (shard, self.worker, now))
+            if cursor.fetchone() is None:
+                return False
+            self._take(cursor, shard, now)
+            return True
+
+    def claim(self, since, now=None):
+        """Lease the shard swept longest ago, if that was before ``since``
+        and no worker holds it. Returns its number, or None when there is
+        nothing left to sweep."""
+        now = int(time.time()) if now is None else now
+        with self.lock, transaction(self.conn, """BEGIN IMMEDIATE"""):
+            cursor = self.conn.cursor()
+            # Leases under our name which we don't know about are left over
+            # from before a restart
+            cursor.execute(
+                """SELECT shard FROM leases WHERE shard < ? AND swept_at < ?
+                AND (worker IS NULL OR worker = ? OR expires_at <= ?)
+                ORDER BY swept_at, shard""",
+                (self.shards, since, self.worker, now))
+            for (shard, ) in cursor.fetchall():
+                if shard not in self.expires:
+                    return self._take(cursor, shard, now)
+            return None
+
+    def hold(self, shard, now=None):
+        """Make sure the lease on ``shard`` has at least half its duration
+        left before acting on one of its PRs, renewing it when needed.
+        Raises :class:`LeaseLost` if another worker has taken it."""
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            if self.expires.get(shard, 0) - now >= self.duration / 2.0:
+                return
+            # Even a lease which ran out is still ours if nobody claimed it,
+            # and so nobody acted on the shard in the meantime
+            with self.conn:
+                cursor = self.conn.execute(
+                    """UPDATE leases SET expires_at = ? WHERE shard = ? AND worker = ?""",
+                    (now + self.duration, shard, self.worker))
+            if cursor.rowcount != 1:
+                self.expires.pop(shard, None)
+                raise LeaseLost("Shard %s was taken over by another worker" % shard)
+            self.expires[shard] = now + self.duration
+
+    def release(self, shard, swept=False, now=None):
+        """Give up the lease on ``shard``, recording that it was swept."""
+        now = int(time.time()) if now is None else now
+        with self.lock:
+            self.expires.pop(shard, None)
+            with self.conn:
+                self.conn.execute(
+                    """UPDATE leases SET worker = NULL, expires_at = 0,
+                    swept_at = CASE WHEN ? THEN ? ELSE swept_at END
+                    WHERE shard = ? AND worker = ?""",
+                    (swept, now, shard, self.worker))
+
+
+class RateLimited(Exception):
+    """GitHub's rate limit, or the budget kept for writes, is used up."""
+
+
+class RateLimit(object):
+    """What is left of one of GitHub's rate limits."""
+
+    __slots__ = ('limit', 'remaining', 'reset_at')
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+
+    def expire(self):
+        # Once the limit has reset, the quota is unknown until a response
+        # reports it again; an exhausted one would otherwise stop every
+        # request, and with them the headers which would lift it.
+        if self.reset_at is not None and time.time() >= self.reset_at:
+            self.remaining = None
+            self.reset_at = None
+
+
+class Scheduler(object):
+    """Keeps a run within GitHub's rate limit.
+
+    The remaining quota is taken from the ``X-RateLimit-*`` headers of every
+    response. GitHub keeps separate limits, named by
+    ``X-RateLimit-Resource``: reads draw on ``read_resource`` (``graphql``
+    for GraphQL listings), writes on ``core``. Reads stop ``reserve``
+    requests short of the limit so there is always budget left to post
+    comments. When there isn't enough for every PR, the PRs closest to
+    matching a filter are examined first and the rest are deferred to the
+    next run.
+    """
 
-        self.timefmt = "%Y-%m-%dT%H:%M:%S.Z"
+    def __init__(self, reserve=0, read_resource='core'):
+        self.reserve = reserve
+        self.read_resource = read_resource
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.blocked_until = None
+        self.start_run()
 
+    def start_run(self):
+        self.used = 0
+        self.deferred = 0
+
+    def budget(self, resource=None):
+        """The :class:`RateLimit` of ``resource``, by default the one reads
+        draw on."""
+        resource = self.read_resource if resource is None else resource
+        with self.lock:
+            return self.limits.setdefault(resource, RateLimit())
+
+    def observe(self, response):
+        """Record the quota reported by ``response``. Returns True if the
+        request was rejected for exceeding a rate limit."""
+        headers = response.headers
+        budget = self.budget(headers.get('x-ratelimit-resource', 'core'))
+        with self.lock:
+            if response.status_code != 304:
+                self.used += 1
+            if 'x-ratelimit-remaining' in headers:
+                budget.remaining = int(headers['x-ratelimit-remaining'])
+                budget.limit = int(headers.get('x-ratelimit-limit', budget.limit or 0))
+                budget.reset_at = int(headers.get('x-ratelimit-reset', 0)) or None
+
+            if response.status_code not in (403, 429):
+                return False
+            # Secondary (abuse) limits say how long to back off, and apply to
+            # every request; an exhausted primary limit stops its own
+            # requests until its reset.
+            if 'retry-after' in headers:
+                self.blocked_until = time.time() + int(headers['retry-after'])
+            elif budget.remaining != 0:
+                return False
+            return True
+
+    def _blocked(self):
+        if self.blocked_until is None:
+            return False
+        if time.time() >= self.blocked_until:
+            self.blocked_until = None
+            return False
+        return True
+
+    def can_read(self, cost=1):
+        budget = self.budget()
+        with self.lock:
+            if self._blocked():
+                return False
+            budget.expire()
+            return budget.remaining is None or budget.remaining - cost >= self.reserve
+
+    def can_write(self):
+        budget = self.budget('core')
+        with self.lock:
+            if self._blocked():
+                return False
+            budget.expire()
+            return budget.remaining is None or budget.remaining > 0
+
+    def schedule(self, prs, pr_filters, comment_store, vote_counter):
+        """Split ``prs``, which each need a comment listing, into those to
+        examine now and those to defer. PRs are ranked by the fewest votes
+        any filter still needs, counted from the comments already stored.
+        Runs schedule a page of the PR listing at a time, so earlier pages
+        come first."""
+        def priority(pr):
+            tally = vote_counter.tally([comment_store.stored(pr)])
+            shortfalls = [pr_filter.shortfall(pr, tally) for pr_filter in pr_filters]
+            shortfalls = [missing for missing in shortfalls if missing is not None]
+            return min(shortfalls) if shortfalls else float('inf')
+
+        budget = self.budget()
+        with self.lock:
+            budget.expire()
+            if budget.remaining is None:
+                return (prs, [])
+            affordable = max(0, budget.remaining - self.reserve)
+            # Claim the requests now, so repositories scheduled at the same
+            # time don't count on the same budget. The next response's
+            # headers replace this estimate.
+            budget.remaining -= min(affordable, len(prs))
+        if affordable >= len(prs):
+            return (prs, [])
+
+        ranked = sorted(prs, key=priority)
+        with self.lock:
+            self.deferred += len(ranked) - affordable
+        return (ranked[:affordable], ranked[affordable:])
+
+    def report(self):
+        log.info("API budget: %s requests used this run (%s kept for writes), "
+                 "%s PRs deferred", self.used, self.reserve, self.deferred)
+        for (resource, budget) in sorted(self.limits.items()):
+            log.info("API budget: %s of %s %s requests remaining",
+                     budget.remaining, budget.limit, resource)
+
+
+class Metrics(object):
+    """Counters and timings for a run, exported as a JSON summary and as a
+    Prometheus textfile.
+
+    Each sample is a name from :attr:`HELP` plus labels; timings accumulate
+    seconds. Samples are updated from the comment prefetch threads, so every
+    access holds a lock.
+    """
+
+    HELP = collections.OrderedDict([
+        ('run_seconds', 'Wall time of the run'),
+        ('run_finished_timestamp_seconds', 'When the run finished'),
+        ('api_requests', 'API requests, by endpoint, method and status'),
+        ('api_request_seconds', 'Time spent waiting for the API, by endpoint'),
+        ('api_pages', 'Pages of results read, by endpoint'),
+        ('api_retries', 'Requests sent again after an error, by endpoint and status'),
+        ('http_cache_hits', 'GET requests answered from the cache'),
+        ('http_cache_misses', 'GET requests answered with a fresh page'),
+        ('prs_examined', 'Changed or due PRs examined, by repository'),
+        ('prs_deferred', 'PRs left for the next run for lack of API budget, by repository'),
+        ('filter_seconds', 'Time spent applying each filter, actions included'),
+        ('filter_matches', 'PRs which passed every condition, by filter'),
+        ('actions_enqueued', 'Actions queued for execution, by filter and action'),
+        ('actions_failed', 'Failed attempts at executing an action, by filter and action'),
+        ('actions_queued', 'Actions waiting in the queue after the run'),
+        ('actions_given_up', 'Actions in the queue which failed too often to be tried again'),
+        ('filter_results_reused', 'PRs not evaluated again, their result being known, by filter'),
+        ('condition_evaluations', 'Conditions evaluated, by filter and condition'),
+        ('condition_seconds', 'Time spent evaluating conditions, by filter and condition'),
+        ('actions_executed', 'Actions which changed something on GitHub, by filter and action'),
+        ('sqlite_statements', 'SQLite statements executed, by operation'),
+        ('sqlite_seconds', 'Time spent in SQLite, by operation'),
+    ])
+
+    def __init__(self, prefix='p4'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(float)
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] += amount
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.samples[key] = value
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.incr(name, time.time() - start, **labels)
+
+    @staticmethod
+    def summary(samples):
+        summary = collections.OrderedDict()
+        for ((name, labels), value) in sorted(samples.items()):
+            summary.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return summary
+
+    def prometheus(self, samples):
+        lines = []
+        for (name, help_text) in self.HELP.items():
+            named = sorted((labels, value) for ((sample_name, labels), value)
+                           in samples.items() if sample_name == name)
+            if not named:
+                continue
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s gauge' % metric)
+            for (labels, value) in named:
+                rendered = ','.join(
+                    '%s="%s"' % (key, str(label).replace('\\', '\\\\')
+                                 .replace('"', '\\"').replace('\n', '\\n'))
+                    for (key, label) in labels)
+                lines.append('%s%s %r' % (metric, '{%s}' % rendered if rendered else '',
+                                          float(value)))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, json_path=None, textfile_path=None):
+        """Write out everything collected since the last export, and start
+        afresh. Returns the summary."""
+        with self.lock:
+            (samples, self.samples) = (self.samples, collections.defaultdict(float))
+
+        summary = self.summary(samples)
+        if json_path:
+            self._write(json_path, json.dumps(summary, indent=2))
+        if textfile_path:
+            self._write(textfile_path, self.prometheus(samples))
+        return summary
+
+    @staticmethod
+    def _write(path, text):
+        # Renamed into place, so collectors never read a partial file
+        with open(path + '.tmp', 'w') as handle:
+            handle.write(text)
+        os.rename(path + '.tmp', path)
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        with self.connection.timed('execute'):
+            return super(TimedCursor, self).execute(*args)
+
+    def executemany(self, *args):
+        with self.connection.timed('executemany'):
+            return super(TimedCursor, self).executemany(*args)
+
+    def fetchone(self):
+        with self.connection.timed('fetch', statement=False):
+            return super(TimedCursor, self).fetchone()
+
+    def fetchall(self):
+        with self.connection.timed('fetch', statement=False):
+            return super(TimedCursor, self).fetchall()
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection which adds the time spent executing statements, fetching
+    rows and committing to :attr:`metrics`."""
+
+    metrics = None
+
+    @contextlib.contextmanager
+    def timed(self, operation, statement=True):
+        if self.metrics is None:
+            yield
+            return
+        if statement:
+            self.metrics.incr('sqlite_statements', operation=operation)
+        with self.metrics.timed('sqlite_seconds', operation=operation):
+            yield
+
+    def cursor(self, factory=TimedCursor):
+        return super(TimedConnection, self).cursor(factory)
+
+    def execute(self, *args):
+        with self.timed('execute'):
+            return super(TimedConnection, self).execute(*args)
+
+    def executemany(self, *args):
+        with self.timed('executemany'):
+            return super(TimedConnection, self).executemany(*args)
+
+    def commit(self):
+        with self.timed('commit', statement=False):
+            return super(TimedConnection, self).commit()
+
+
+class ResponseCache(object):
+    """ETag/Last-Modified cache of GitHub GET responses, keyed by URL.
+
+    Lookups go to the ``http_cache`` table; new responses are held in memory
+    until :meth:`flush` writes them in one transaction. It is used from the
+    comment prefetch threads, so every access holds a lock.
+    """
+
+    def __init__(self, conn, lock=None):
+        self.conn = conn
+        self.lock = threading.RLock() if lock is None else lock
+        self.pending = {}
+        self.start_run()
+
+    def start_run(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url):
+        with self.lock:
+            if url in self.pending:
+                return self.pending[url]
+
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT etag, last_modified, link, body FROM http_cache WHERE url = ?""",
+                (url, ))
+            row = cursor.fetchone()
+        if row is None:
+            return row
+        return (row[0], row[1], row[2], bytes(row[3]))
+
+    def put(self, url, etag, last_modified, link, body):
+        with self.lock:
+            self.pending[url] = (etag, last_modified, link, body)
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def prune(self, owner, repo, open_numbers):
+        """Drop cached pages of comments on the repository's issues and PRs
+        whose number isn't among ``open_numbers``."""
+        issue = re.compile(r'/repos/%s/%s/issues/(\d+)/' % (re.escape(owner), re.escape(repo)))
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("""SELECT url FROM http_cache WHERE url LIKE ?""",
+                           ('%%/repos/%s/%s/issues/%%' % (owner, repo), ))
+            urls = list(self.pending) + [url for (url, ) in cursor.fetchall()]
+            stale = set(url for url in urls if issue.search(url)
+                        and int(issue.search(url).group(1)) not in open_numbers)
+            for url in stale:
+                self.pending.pop(url, None)
+            with self.conn:
+                self.conn.executemany("""DELETE FROM http_cache WHERE url = ?""",
+                                      [(url, ) for url in stale])
+        return len(stale)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return 0
+
+            rows = [(url, etag, last_modified, link, sqlite3.Binary(body))
+                    for (url, (etag, last_modified, link, body)) in self.pending.items()]
+            with self.conn:
+                self.conn.executemany(
+                    """INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?)""", rows)
+            self.pending.clear()
+        return len(rows)
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter which makes every GET conditional.
+
+    When GitHub answers ``304 Not Modified`` the cached page is handed back
+    to pygithub3 as if it were a fresh ``200``, so pagination keeps working
+    and the request doesn't count against the rate limit.
+
+    Requests without a timeout of their own get ``timeout``. Up to
+    ``retries`` times, a request is sent again after a server error (GETs
+    only, a POST may have gone through) or a secondary rate limit which
+    asks to wait no longer than ``max_retry_wait`` seconds. Server errors
+    are retried after ``backoff`` seconds, doubling each time.
+    """
+
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, cache, scheduler=None, metrics=None, timeout=None, retries=0,
+                 backoff=1.0, max_retry_wait=60, **kwargs):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.metrics = Metrics() if metrics is None else metrics
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_wait = max_retry_wait
+        super(CachingAdapter, self).__init__(**kwargs)
+
+    @staticmethod
+    def cache_key(url):
+        # Never persist credentials passed as a query parameter.
+        return re.sub(r'([?&])access_token=[^&]*&?', r'\1', url).rstrip('?&')
+
+    @staticmethod
+    def endpoint(url):
+        """``url``'s path relative to the repository, with numbers replaced,
+        e.g. ``issues/:number/comments``."""
+        path = requests.compat.urlparse(url).path
+        path = re.sub(r'^.*?/repos/[^/]+/[^/]+(/|$)', '', path)
+        return re.sub(r'(^|/)\d+(?=/|$)', r'\1:number', path) or '/'
+
+    def retry_wait(self, request, response, attempt):
+        """Seconds to wait before sending ``request`` again after
+        ``response``, or None to give up on it."""
+        if attempt >= self.retries:
+            return None
+        if response.status_code in (403, 429) and 'retry-after' in response.headers:
+            wait = int(response.headers['retry-after'])
+            return wait if wait <= self.max_retry_wait else None
+        if response.status_code in self.RETRY_STATUSES and request.method in ('GET', 'HEAD'):
+            return self.backoff * 2 ** attempt
+        return None
+
+    def _send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        endpoint = self.endpoint(request.url)
+        attempt = 0
+        while True:
+            with self.metrics.timed('api_request_seconds', endpoint=endpoint):
+                response = super(CachingAdapter, self).send(request, **kwargs)
+            self.metrics.incr('api_requests', endpoint=endpoint, method=request.method,
+                              status=response.status_code)
+            wait = self.retry_wait(request, response, attempt)
+            if wait is None:
+                return response
+            # Still counts against the quota, and may block other reads
+            # until the wait is over
+            if self.scheduler is not None:
+                self.scheduler.observe(response)
+            log.warning("%s %s answered %s, retrying in %ss", request.method,
+                        self.cache_key(request.url), response.status_code, wait)
+            self.metrics.incr('api_retries', endpoint=endpoint, status=response.status_code)
+            response.close()
+            time.sleep(wait)
+            attempt += 1
+
+    def _observe(self, request, response):
+        if self.scheduler is not None and self.scheduler.observe(response):
+            raise RateLimited("%s %s was rate limited" % (
+                request.method, self.cache_key(request.url)))
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            response = self._send(request, **kwargs)
+            self._observe(request, response)
+            return response
+
+        key = self.cache_key(request.url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            (etag, last_modified, link, body) = cached
+            if etag:
+                request.headers['If-None-Match'] = etag
+            if last_modified:
+                request.headers['If-Modified-Since'] = last_modified
+
+        response = self._send(request, **kwargs)
+        self._observe(request, response)
+
+        if response.status_code == 304 and cached is not None:
+            self.cache.record(hit=True)
+            self.metrics.incr('http_cache_hits')
+            response.status_code = 200
+            response._content = body
+            if link:
+                response.headers['link'] = link
+        elif response.status_code == 200:
+            self.cache.record(hit=False)
+            self.metrics.incr('http_cache_misses')
+            etag = response.headers.get('etag')
+            last_modified = response.headers.get('last-modified')
+            if etag or last_modified:
+                self.cache.put(key, etag, last_modified,
+                               response.headers.get('link'), response.content)
+        if response.status_code == 200:
+            self.metrics.incr('api_pages', endpoint=self.endpoint(request.url))
+        return response
+
+
+def verify_signature(secret, body, signature):
+    """Check a webhook's ``X-Hub-Signature-256`` header against ``body``."""
+    if not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature[len('sha256='):])
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not verify_signature(self.server.secret, body,
+                                self.headers.get('X-Hub-Signature-256')):
+            log.warning("Rejected webhook with a bad signature")
+            return self._reply(403, {'error': 'bad signature'})
+
+        event = self.headers.get('X-GitHub-Event')
+        try:
+            matched = self.server.bot.handle_event(event, ghjson.loads(body.decode('utf-8')))
+        except Exception:
+            log.exception("Failed to handle %s webhook", event)
+            return self._reply(500, {'error': 'failed to handle event'})
+        if matched is None:
+            # Stored, and evaluated after the sweep under way
+            return self._reply(202, {'delayed': True})
+        self._reply(200, {'matched': matched})
+
+    def log_message(self, format, *args):
+        log.debug("Webhook: " + format, *args)
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    """Accepts ``pull_request`` and ``issue_comment`` webhooks for a bot.
+    Each answer lists the names of the filters the PR matched, or is a
+    ``202`` when the PR is left until the sweep under way is done."""
+
+    daemon_threads = True
+
+    def __init__(self, address, bot, secret):
+        if not secret:
+            raise ValueError("A webhook secret is required")
+        HTTPServer.__init__(self, address, WebhookHandler)
+        self.bot = bot
+        self.secret = secret
+
+
+class Repository(object):
+    """A watched repository with its own filters and approvers."""
+
+    def __init__(self, owner, name, filters, pr_approvers, bot_user=None,
+                 comment_store=None, scheduler=None, metrics=None, ledger=None, client=None,
+                 queue=None):
+        self.owner = owner
+        self.name = name
+        # One counter per repository, so all of its filters share a tally
+        self.vote_counter = VoteCounter(pr_approvers)
         self.pr_filters = []
-        for rule in self.config['repository']['filters']:
+        for rule in filters:
             prf = PullRequestFilter(
                 name=rule['name'],
                 conditions=rule['conditions'],
                 actions=rule['actions'],
+                committer_group=pr_approvers,
+                repo_owner=owner,
+                repo_name=name,
+                bot_user=bot_user,
+                comment_store=comment_store,
+                vote_counter=self.vote_counter,
+                scheduler=scheduler,
+                metrics=metrics,
+                ledger=ledger,
+                client=client,
+                queue=queue,
+            )
+            self.pr_filters.append(prf)
+        # PRs are read with only the fields some filter needs
+        self.fields = set().union(*[prf.fields for prf in self.pr_filters])
+        self.queries = self.plan()
+        log.info("Listing open PRs of %s with %s", self, self.queries)
+
+    def plan(self):
+        """Parameters of the listings which between them include every open
+        PR any filter can match: one per branch when every filter wants a
+        particular one, a single unrestricted listing otherwise, and none
+        when no filter can match an open PR."""
+        queries = [query for query in (prf.query() for prf in self.pr_filters)
+                   if query is not None]
+        if not all(queries):
+            return [{}]
+        return [{'base': base} for base in sorted(set(query['base'] for query in queries))]
+
+    def next_due(self, pr, now):
+        """When any filter's time-based conditions next change for ``pr``."""
+        due = [pr_filter.next_due(pr, now) for pr_filter in self.pr_filters]
+        due = [when for when in due if when is not None]
+        return min(due) if due else None
+
+    def __str__(self):
+        return '%s/%s' % (self.owner, self.name)
+
+
+class Snapshot(object):
+    """Every open PR and its votes, as columns, for evaluating rules
+    offline.
+
+    Only comments which vote are kept, reduced to who voted which way, so a
+    snapshot stays small and approvers can still be changed when it is
+    evaluated. Saved as gzipped JSON.
+    """
+
+    PR_COLUMNS = ('owner', 'repo', 'number', 'id', 'title', 'state', 'base', 'author',
+                  'created_at', 'updated_at')
+    ARRAY_TYPES = {'number': 'l', 'id': 'l', 'created_at': 'd', 'updated_at': 'd',
+                   'pr': 'l', 'plus': 'b', 'minus': 'b'}
+
+    def __init__(self, recorded_at=None, prs=None, votes=None):
+        # Naive local time, as older_than is evaluated against
+        self.recorded_at = to_epoch(datetime.datetime.now()) if recorded_at is None else recorded_at
+        self.prs = self._columns(self.PR_COLUMNS, prs)
+        self.votes = self._columns(('pr', 'login', 'plus', 'minus'), votes)
 
-                # ugh
-                committer_group=self.config['repository']['pr_approvers'],
-                repo_owner=self.config['repository']['owner'],
-                repo_name=self.config['repository']['name'],
+    def _columns(self, names, data=None):
+        data = data or {}
+        return dict((name, array(self.ARRAY_TYPES[name], data.get(name, []))
+                     if name in self.ARRAY_TYPES else list(data.get(name, [])))
+                    for name in names)
+
+    def __len__(self):
+        return len(self.prs['number'])
+
+    def add(self, pr, comments):
+        index = len(self)
+        for (column, value) in (
+                ('owner', pr.repo_owner), ('repo', pr.repo_name), ('number', pr.number),
+                ('id', pr.id), ('title', pr.title), ('state', pr.state),
+                ('base', pr.base), ('author', pr.user['login']),
+                ('created_at', to_epoch(pr.created_at)),
+                ('updated_at', to_epoch(pr.updated_at))):
+            self.prs[column].append(value)
+
+        for comment in comments:
+            plus = VoteCounter.PLUS.search(comment.body) is not None
+            minus = VoteCounter.MINUS.search(comment.body) is not None
+            if plus or minus:
+                for (column, value) in (('pr', index), ('login', comment.user['login']),
+                                        ('plus', plus), ('minus', minus)):
+                    self.votes[column].append(value)
+
+    def save(self, path):
+        data = {
+            'recorded_at': self.recorded_at,
+            'prs': dict((name, list(column)) for (name, column) in self.prs.items()),
+            'votes': dict((name, list(column)) for (name, column) in self.votes.items()),
+        }
+        with gzip.open(path, 'wb') as handle:
+            handle.write(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rb') as handle:
+            data = json.loads(handle.read().decode('utf-8'))
+        return cls(data['recorded_at'], data['prs'], data['votes'])
+
+    def tally(self, approvers):
+        """Approvers' ``(plus, minus)`` vote counts, one array entry per PR."""
+        approvers = frozenset(approvers)
+        plus = array('l', [0]) * len(self)
+        minus = array('l', [0]) * len(self)
+        votes = self.votes
+        for (pr, login, is_plus, is_minus) in zip(votes['pr'], votes['login'],
+                                                  votes['plus'], votes['minus']):
+            if login in approvers:
+                plus[pr] += is_plus
+                minus[pr] += is_minus
+        return (plus, minus)
+
+    def _test(self, pr_filter, check_key, condition_value, tally):
+        """Column-wise equivalent of ``pr_filter``'s ``check_<check_key>``:
+        a function from a row to the value the check would return."""
+        if check_key == 'state':
+            column = self.prs['state']
+            return lambda row: column[row] == condition_value
+        if check_key == 'title_contains':
+            column = self.prs['title']
+            return lambda row: condition_value in column[row]
+        if check_key == 'to_branch':
+            column = self.prs['base']
+            return lambda row: column[row] == condition_value
+        if check_key == 'older_than':
+            recorded_at = EPOCH + datetime.timedelta(seconds=self.recorded_at)
+            threshold = to_epoch(pr_filter.calendar.parseDT(condition_value, recorded_at)[0])
+            column = self.prs['created_at']
+            return lambda row: column[row] < threshold
+        column = tally[0] if check_key == 'plus' else tally[1]
+        return column.__getitem__
+
+    def matches(self, pr_filter, owner, repo, tally):
+        """Rows of ``owner/repo`` PRs which pass every condition of
+        ``pr_filter``, as they were when the snapshot was recorded."""
+        rows = [row for (row, (row_owner, row_repo))
+                in enumerate(zip(self.prs['owner'], self.prs['repo']))
+                if row_owner == owner and row_repo == repo]
+        for (condition_key, condition_value, predicate) in pr_filter.plan:
+            (check_key, condition_op) = (condition_key.split('__', 1) + [None])[:2]
+            test = self._test(pr_filter, check_key, condition_value, tally)
+            if check_key in ('plus', 'minus'):
+                compare = pr_filter.NUMERIC_OPS[condition_op]
+                threshold = int(condition_value)
+                rows = [row for row in rows if compare(test(row), threshold)]
+            elif condition_op == 'not':
+                rows = [row for row in rows if not test(row)]
+            else:
+                rows = [row for row in rows if test(row)]
+        return rows
+
+
+class MergerBot(object):
+
+    def __init__(self, conf_path, worker=None):
+        with open(conf_path, 'r') as handle:
+            self.config = yaml.load(handle)
+
+        self.concurrency = int(self.config['meta'].get('concurrency', 1))
+        # Pages of PRs each stage of a run may get ahead of the next
+        self.pipeline_depth = int(self.config['meta'].get('pipeline_depth', 2))
+        # Workers sharing the database split the work into this many shards
+        self.shards = int(self.config['meta'].get('shards', 1))
+        self.shard_by = self.config['meta'].get('shard_by', 'repository')
+        if self.shard_by not in ('repository', 'pr'):
+            raise ValueError("Unknown shard_by %s, expected repository or pr" % self.shard_by)
+        self.worker = worker or '%s:%s' % (socket.gethostname(), os.getpid())
+        self.client = make_client(self.config['meta'])
+        self.metrics = Metrics()
+        # Summary of the last run's metrics
+        self.run_metrics = None
+
+        self.create_db(database_name=os.path.abspath(
+            self.config['meta']['database_path']))
+        self.scheduler = Scheduler(
+            reserve=int(self.config['meta'].get('rate_limit_reserve', 0)),
+            read_resource='graphql' if self.config['meta'].get('api') == 'graphql' else 'core')
+        self.executor = ActionExecutor(
+            self.action_queue, self.client, self.ledger, scheduler=self.scheduler,
+            metrics=self.metrics, bot_user=self.config['meta']['bot_user'],
+            write_interval=float(self.config['meta'].get('write_interval', 1)),
+            backoff=float(self.config['meta'].get('action_backoff', 60)))
+        self.stopping = threading.Event()
+        # Webhook evaluations wait for a running sweep, and vice versa
+        self.run_lock = threading.RLock()
+        # PRs whose webhooks arrived during a sweep, by (owner, repo, number)
+        self.delayed_events = set()
+        # The WebhookServer delivering to this bot, if any
+        self.webhook_server = None
+        # Latest listing of every open PR, by (owner, repo, number)
+        self.open_prs = {}
+
+        self.repositories = [
+            Repository(
+                owner=repository['owner'],
+                name=repository['name'],
+                filters=repository['filters'],
+                pr_approvers=repository['pr_approvers'],
                 bot_user=self.config['meta']['bot_user'],
+                comment_store=self.comments,
+                scheduler=self.scheduler,
+                metrics=self.metrics,
+                ledger=self.ledger,
+                client=self.client,
+                queue=self.action_queue,
             )
-            self.pr_filters.append(prf)
+            for repository in self.repository_configs()
+        ]
+        # Made once and kept for every run: one pool sweeps repositories,
+        # another fetches comments for all of them, so neither waits on
+        # itself.
+        self.repository_pool = worker_pool(min(self.concurrency, len(self.repositories)))
+        self.fetch_pool = worker_pool(self.concurrency)
+
+        self.install_http_cache()
+
+    def repository_configs(self):
+        """Settings for each watched repository: every entry of
+        ``repositories`` layered over ``defaults``. A lone ``repository``
+        block is still accepted."""
+        defaults = self.config.get('defaults') or {}
+        repositories = self.config.get('repositories') or [self.config['repository']]
+        return [dict(defaults, **repository) for repository in repositories]
+
+    # The schema's version, kept in SQLite's user_version. Each increment
+    # comes with a _migrate_<version> method which upgrades the previous one.
+    SCHEMA_VERSION = 6
 
     def create_db(self, database_name='cache.sqlite'):
-        self.conn = sqlite3.connect(database_name)
+        # Repositories are processed from several threads; every store
+        # serialises its use of the connection through db_lock.
+        self.conn = sqlite3.connect(database_name, check_same_thread=False,
+                                    factory=TimedConnection)
+        self.conn.metrics = self.metrics
+        self.db_lock = threading.RLock()
+        if self.config['meta'].get('wal', False):
+            # Let readers proceed while a flush is being written
+            self.conn.execute("PRAGMA journal_mode=WAL")
         cursor = self.conn.cursor()
+        cursor.execute("""PRAGMA user_version""")
+        version = cursor.fetchone()[0]
+        if version > self.SCHEMA_VERSION:
+            raise ValueError("%s has schema version %s, but this bot only knows up to %s" % (
+                database_name, version, self.SCHEMA_VERSION))
+        self.ledger_unreconciled = False
+        for step in range(version + 1, self.SCHEMA_VERSION + 1):
+            log.info("Migrating %s to schema version %s", database_name, step)
+            with self._transaction():
+                getattr(self, '_migrate_%s' % step)(cursor)
+                cursor.execute("""PRAGMA user_version = %d""" % step)
+        if self.ledger_unreconciled:
+            # Pending until reconcile_ledger has run
+            with self._transaction():
+                cursor.execute(
+                    """INSERT OR REPLACE INTO maintenance(task, last_run)
+                    VALUES ('reconcile_ledger', NULL)""")
+        cursor.execute(
+            """SELECT 1 FROM maintenance WHERE task = 'reconcile_ledger' AND last_run IS NULL""")
+        self.ledger_unreconciled = cursor.fetchone() is not None
+        if self.ledger_unreconciled:
+            log.info("Comments posted before the action ledger existed will be recorded "
+                     "in it before anything else is done")
+
+        self.state = StateStore(self.conn, lock=self.db_lock)
+        self.results = FilterResults(self.conn, lock=self.db_lock)
+        self.comments = CommentStore(self.conn, fetch=self.client.comments, lock=self.db_lock)
+        self.http_cache = ResponseCache(self.conn, lock=self.db_lock)
+        self.ledger = ActionLedger(self.conn, lock=self.db_lock)
+        self.action_queue = ActionQueue(
+            self.conn, lock=self.db_lock,
+            max_attempts=int(self.config['meta'].get('action_max_attempts', 5)))
+        self.cursors = ListingCursors(self.conn, lock=self.db_lock)
+        self.leases = LeaseStore(self.conn, self.worker, self.shards,
+                                 duration=int(self.config['meta'].get('lease_seconds', 300)),
+                                 lock=self.db_lock)
+
+    def _transaction(self):
+        # A migration is applied entirely or not at all
+        return transaction(self.conn)
+
+    def _migrate_1(self, cursor):
+        # Creates the schema as it was before it had a version, or brings any
+        # earlier database up to it.
+        # pr_data used to be keyed by pr_id alone
+        pr_data_columns = self._columns(cursor, 'pr_data')
+        legacy_pr_data = pr_data_columns and 'owner' not in pr_data_columns
+        if pr_data_columns and not self._columns(cursor, 'action_ledger'):
+            # Comments the bot posted before the action ledger existed have
+            # to be found before any action is executed, see create_db
+            cursor.execute("""SELECT COUNT(*) FROM pr_data""")
+            self.ledger_unreconciled = cursor.fetchone()[0] > 0
+        if legacy_pr_data:
+            cursor.execute("""ALTER TABLE pr_data RENAME TO pr_data_legacy""")
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS pr_data(
-                pr_id INTEGER PRIMARY KEY,
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                updated_at TEXT,
+                next_due TEXT,
+                PRIMARY KEY (owner, repo, pr_id)
+            )
+            """
+        )
+        if legacy_pr_data:
+            self._migrate_legacy_pr_data(cursor)
+        elif 'next_due' not in self._columns(cursor, 'pr_data'):
+            cursor.execute("""ALTER TABLE pr_data ADD COLUMN next_due TEXT""")
+        cursor.execute(
+            """CREATE INDEX IF NOT EXISTS pr_data_next_due ON pr_data(owner, repo, next_due)""")
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS http_cache(
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                link TEXT,
+                body BLOB
+            )
+            """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pr_comments(
+                comment_id INTEGER PRIMARY KEY,
+                pr_id INTEGER,
+                login TEXT,
+                body TEXT,
                 updated_at TEXT
             )
             """
         )
+        cursor.execute(
+            """CREATE INDEX IF NOT EXISTS pr_comments_pr_id ON pr_comments(pr_id)""")
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS action_ledger(
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                filter TEXT,
+                action_hash TEXT,
+                comment_id INTEGER,
+                executed_at TEXT,
+                PRIMARY KEY (owner, repo, pr_id, filter, action_hash)
+            )
+            """
+        )
 
-    def fetch_pr_from_db(self, id):
-        cursor = self.conn.cursor()
-        cursor.execute("""SELECT * FROM pr_data WHERE pr_id == ?""", (str(id), ))
-        row = cursor.fetchone()
+    def _migrate_2(self, cursor):
+        # Times become integer seconds since the epoch, and comments are
+        # keyed by repository like everything else. Comments of PRs whose
+        # repository isn't known are dropped, and fetched again if needed.
+        def epoch(column):
+            return """CAST(strftime('%%s', substr(%s, 1, 19)) AS INTEGER)""" % column
 
-        if row is None:
-            return row
+        for index in ('pr_data_next_due', 'pr_comments_pr_id'):
+            cursor.execute("""DROP INDEX IF EXISTS %s""" % index)
+        for table in ('pr_data', 'pr_comments', 'action_ledger'):
+            cursor.execute("""ALTER TABLE %s RENAME TO %s_v1""" % (table, table))
 
-        pretty_row = (
-            row[0],
-            datetime.datetime.strptime(row[1], self.timefmt)
+        cursor.execute(
+            """
+            CREATE TABLE pr_data(
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                updated_at INTEGER,
+                next_due INTEGER,
+                PRIMARY KEY (owner, repo, pr_id)
+            )
+            """
         )
-        return pretty_row
+        cursor.execute(
+            """INSERT INTO pr_data SELECT owner, repo, pr_id, %s, %s FROM pr_data_v1""" % (
+                epoch('updated_at'), epoch('next_due')))
+        cursor.execute(
+            """CREATE INDEX pr_data_next_due ON pr_data(owner, repo, next_due)""")
 
-    def cache_pr(self, id, updated_at):
-        cursor = self.conn.cursor()
-        cursor.execute("""INSERT INTO pr_data VALUES (?, ?)""",
-                       (str(id), updated_at.strftime(self.timefmt)))
-        self.conn.commit()
+        cursor.execute(
+            """
+            CREATE TABLE pr_comments(
+                comment_id INTEGER PRIMARY KEY,
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                login TEXT,
+                body TEXT,
+                updated_at INTEGER
+            )
+            """
+        )
+        cursor.execute(
+            """INSERT INTO pr_comments SELECT comment_id, owner, repo, pr_comments_v1.pr_id,
+            login, body, %s FROM pr_comments_v1 JOIN pr_data USING (pr_id)""" % (
+                epoch('pr_comments_v1.updated_at')))
+        cursor.execute(
+            """CREATE INDEX pr_comments_pr ON pr_comments(owner, repo, pr_id)""")
 
-    def update_pr(self, id, updated_at):
-        cursor = self.conn.cursor()
-        cursor.execute("""UPDATE pr_data SET updated_at = ? where pr_id = ?""",
-                       (updated_at.strftime(self.timefmt), str(id)))
-        self.conn.commit()
-
-    def get_prs2(self):
-        results = gh.pull_requests.list(
-            state='open',
-            user=self.config['repository']['owner'],
-            repo=self.config['repository']['name'])
-        # This will contain a list of all new/updated PRs to filter
-        changed_prs = []
-        # Loop across our GH results
-        for page in results:
-            for resource in page:
-                # Fetch the PR's ID which we use as a key in our db.
-                cached_pr = self.fetch_pr_from_db(resource.id)
-                # If it's new, cache it.
-                if cached_pr is None:
-                    self.cache_pr(resource.id, resource.updated_at)
-                    changed_prs.append(PullRequest(resource))
-                else:
-                    # compare updated_at times.
-                    cached_pr_time = cached_pr[1]
-                    log.debug(cached_pr_time, resource.updated_at)
-                    if cached_pr_time != resource.updated_at:
-                        changed_prs.append(PullRequest(resource))
-        return changed_prs
+        cursor.execute(
+            """
+            CREATE TABLE action_ledger(
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                filter TEXT,
+                action_hash TEXT,
+                comment_id INTEGER,
+                executed_at INTEGER,
+                PRIMARY KEY (owner, repo, pr_id, filter, action_hash)
+            )
+            """
+        )
+        cursor.execute(
+            """INSERT INTO action_ledger SELECT owner, repo, pr_id, filter, action_hash,
+            comment_id, %s FROM action_ledger_v1""" % epoch('executed_at'))
 
-    def run(self):
-        changed_prs = self.get_prs2()
-        log.info("Found %s PRs to examine", len(changed_prs))
+        for table in ('pr_data', 'pr_comments', 'action_ledger'):
+            cursor.execute("""DROP TABLE %s_v1""" % table)
+
+        # When ANALYZE and VACUUM last ran, see maintain()
+        cursor.execute(
+            """
+            CREATE TABLE maintenance(
+                task TEXT PRIMARY KEY,
+                last_run INTEGER
+            )
+            """
+        )
+
+    def _migrate_3(self, cursor):
+        # Which worker holds each shard, and when it was last swept, see
+        # LeaseStore
+        cursor.execute(
+            """
+            CREATE TABLE leases(
+                shard INTEGER PRIMARY KEY,
+                worker TEXT,
+                expires_at INTEGER,
+                swept_at INTEGER
+            )
+            """
+        )
+
+    def _migrate_4(self, cursor):
+        # Whether each filter matched each PR, see FilterResults
+        cursor.execute(
+            """
+            CREATE TABLE filter_results(
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                filter TEXT,
+                rule_hash TEXT,
+                updated_at INTEGER,
+                valid_until INTEGER,
+                matched INTEGER,
+                PRIMARY KEY (owner, repo, pr_id, filter)
+            )
+            """
+        )
+
+    def _migrate_5(self, cursor):
+        # Actions waiting to be executed, see ActionQueue
+        cursor.execute(
+            """
+            CREATE TABLE action_queue(
+                owner TEXT,
+                repo TEXT,
+                pr_id INTEGER,
+                filter TEXT,
+                action_hash TEXT,
+                number INTEGER,
+                action TEXT,
+                body TEXT,
+                attempts INTEGER,
+                not_before INTEGER,
+                queued_at INTEGER,
+                last_error TEXT,
+                PRIMARY KEY (owner, repo, pr_id, filter, action_hash)
+            )
+            """
+        )
+        cursor.execute(
+            """CREATE INDEX action_queue_not_before ON action_queue(not_before)""")
+
+    def _migrate_6(self, cursor):
+        # Checkpoints of listings being backfilled, see ListingCursors
+        cursor.execute(
+            """
+            CREATE TABLE listing_cursors(
+                owner TEXT,
+                repo TEXT,
+                listing TEXT,
+                cursor TEXT,
+                completed_at INTEGER,
+                PRIMARY KEY (owner, repo, listing)
+            )
+            """
+        )
+
+    @staticmethod
+    def _columns(cursor, table):
+        cursor.execute("""PRAGMA table_info(%s)""" % table)
+        return [row[1] for row in cursor.fetchall()]
+
+    def _migrate_legacy_pr_data(self, cursor):
+        # Old rows belong to the single configured repository, however it is
+        # configured. Without one to attribute them to they are dropped, and
+        # those PRs are simply examined again.
+        configs = self.repository_configs()
+        if len(configs) == 1:
+            cursor.execute(
+                """INSERT INTO pr_data(owner, repo, pr_id, updated_at)
+                SELECT ?, ?, pr_id, updated_at FROM pr_data_legacy""",
+                (configs[0]['owner'], configs[0]['name']))
+        else:
+            cursor.execute("""SELECT COUNT(*) FROM pr_data_legacy""")
+            log.warning("Dropping %s PRs stored before repositories were told apart: with %s "
+                        "repositories configured they can't be attributed to one, so they "
+                        "are examined again", cursor.fetchone()[0], len(configs))
+        cursor.execute("""DROP TABLE pr_data_legacy""")
+
+    def install_http_cache(self):
+        # One adapter, and so one keep-alive connection pool, serves every
+        # service; it needs a connection per concurrent request: the comment
+        # fetches, and the listing of each repository being processed.
+        parallel = self.concurrency + min(self.concurrency, len(self.repositories))
+        meta = self.config['meta']
+        adapter = CachingAdapter(
+            self.http_cache, scheduler=self.scheduler, metrics=self.metrics,
+            pool_maxsize=max(parallel, 10),
+            timeout=(float(meta.get('connect_timeout', 10)), float(meta.get('read_timeout', 60))),
+            retries=int(meta.get('retries', 3)),
+            backoff=float(meta.get('retry_backoff', 1)),
+            max_retry_wait=int(meta.get('max_retry_wait', 60)))
+        for (session, base_url) in self.client.sessions():
+            session.mount(base_url, adapter)
+
+    def shard_of(self, repository, number):
+        """The shard PR ``number`` of ``repository`` belongs to. The same in
+        every worker, unlike ``hash``."""
+        key = '%s/%s' % (repository.owner, repository.name)
+        if self.shard_by == 'pr':
+            key += '#%s' % number
+        return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % self.shards
+
+    def get_prs2(self, repository, shard=None):
+        """New and updated PRs of ``repository``, a :class:`Page` per page of
+        the listings its filters need, see :meth:`Repository.plan`. With a
+        ``shard``, only those belonging to it.
+
+        Listings which never completed are backfills: they continue where
+        the last one stopped, see :class:`ListingCursors`, and each of their
+        pages carries the ``listing`` to checkpoint once it is evaluated."""
+        # PRs whose time-based conditions may have changed since they were
+        # last evaluated are examined even if nothing else changed.
+        now = datetime.datetime.now()
+        due = self.state.due(repository.owner, repository.name, now)
+        # Number of every open PR, by ID
+        listed = {}
+        # Whether a listing skipped the pages before its cursor
+        resumed = False
+        # Loop across our GH results, stopping early rather than spending the
+        # budget kept for writes. Unlisted PRs are picked up next run.
+        if not self.scheduler.can_read():
+            log.warning("No API budget left to list PRs in %s", repository)
+            return
+        for query in repository.queries:
+            listing = json.dumps(dict(query, shard=shard), sort_keys=True)
+            (backfill, after) = self.cursors.resume(repository.owner, repository.name, listing)
+            if after is not None:
+                log.info("Resuming the backfill of %s %s after %s", repository, listing, after)
+                resumed = True
+            for page in self.client.pull_requests(repository.owner, repository.name,
+                                                  after=after, **query):
+                # This will contain the new/updated PRs to filter
+                changed_prs = Page(cursor=page.cursor)
+                changed_prs.listing = listing if backfill else None
+                for resource in page:
+                    pr = PullRequest(resource, repo_owner=repository.owner,
+                                     repo_name=repository.name, fields=repository.fields)
+                    listed[pr.id] = pr.number
+                    self.open_prs[(repository.owner, repository.name, pr.number)] = pr
+                    if shard is not None and self.shard_of(repository, pr.number) != shard:
+                        continue
+                    # The PR's ID is the key in our db. New PRs have no cached
+                    # time, so they always compare as changed.
+                    cached_pr_time = self.state.get((repository.owner, repository.name, pr.id))
+                    log.debug("%s %s", cached_pr_time, pr.updated_at)
+                    # Unchanged PRs are examined again when a filter was edited
+                    if cached_pr_time != pr.updated_at or pr.id in due or \
+                            self.stale_filters(repository, pr.id, pr.updated_at, now):
+                        self.preload_comments(pr, resource)
+                        changed_prs.append(pr)
+                # Backfills checkpoint every page, changed PRs or not
+                if changed_prs or backfill:
+                    yield changed_prs
+                if not self.scheduler.can_read():
+                    log.warning("API budget ran out while listing PRs in %s", repository)
+                    return
+        if resumed:
+            log.info("Not forgetting closed PRs in %s after a resumed listing", repository)
+            return
+        # Only complete listings show which PRs were closed. PRs no filter
+        # can match, outside the listings, are forgotten too; should the
+        # configuration change, they are examined as new.
+        self.prune(repository, listed)
+
+    def pull_request(self, repository, resource):
+        pr = PullRequest(resource, repo_owner=repository.owner, repo_name=repository.name)
+        self.preload_comments(pr, resource)
+        return pr
+
+    def preload_comments(self, pr, resource):
+        # Listings which include every comment save asking for them
+        listed_comments = getattr(resource, 'listed_comments', None)
+        if listed_comments is not None:
+            self.comments.preload(pr, listed_comments)
+
+    def prune(self, repository, listed):
+        """Drop what is stored about the repository's PRs which are no longer
+        open. ``listed`` maps the ID of every open PR to its number."""
+        closed = self.state.prune(repository.owner, repository.name, listed)
+        if not closed:
+            return
+        self.results.prune(repository.owner, repository.name, closed)
+        self.comments.prune(repository.owner, repository.name, closed)
+        open_numbers = set(listed.values())
+        self.http_cache.prune(repository.owner, repository.name, open_numbers)
+        for key in list(self.open_prs):
+            if key[:2] == (repository.owner, repository.name) and key[2] not in open_numbers:
+                del self.open_prs[key]
+        log.info("Forgot %s PRs in %s which are no longer open", len(closed), repository)
+
+    def maintain(self, now=None):
+        """ANALYZE and VACUUM the database when meta.vacuum_interval seconds,
+        a week by default, have passed since they last ran. Returns whether
+        they ran."""
+        interval = int(self.config['meta'].get('vacuum_interval', 7 * 24 * 3600))
+        now = int(time.time()) if now is None else now
+        if interval <= 0:
+            return False
+        with self.db_lock:
+            # Only one of the workers sharing the database gets to run them
+            with transaction(self.conn, """BEGIN IMMEDIATE"""):
+                cursor = self.conn.cursor()
+                cursor.execute("""SELECT last_run FROM maintenance WHERE task = 'vacuum'""")
+                row = cursor.fetchone()
+                if row is not None and now - row[0] < interval:
+                    return False
+
+                log.info("Running ANALYZE and VACUUM")
+                cursor.execute("""ANALYZE""")
+                cursor.execute(
+                    """INSERT OR REPLACE INTO maintenance(task, last_run) VALUES ('vacuum', ?)""",
+                    (now, ))
+            try:
+                self.conn.execute("""VACUUM""")
+            except sqlite3.OperationalError as exc:
+                # Another worker is writing; try again next interval
+                log.warning("Could not VACUUM: %s", exc)
+        return True
+
+    def prefetch(self, repository, pages):
+        """Fetch the comments each page of changed PRs will need, so
+        evaluation reads them from the store. Yields every page with the
+        PRs the API budget didn't stretch to, which are left for the next
+        run."""
+        for changed_prs in pages:
+            now = datetime.datetime.now()
+            (scheduled, deferred) = self.scheduler.schedule(
+                [pr for pr in changed_prs
+                 if any(pr_filter.needs_comments(pr) for pr_filter
+                        in self.stale_filters(repository, pr.id, pr.updated_at, now))],
+                repository.pr_filters, self.comments, repository.vote_counter)
+            self.comments.prefetch(scheduled, pool=self.fetch_pool)
+            if deferred:
+                log.info("Deferring %s PRs in %s to the next run", len(deferred), repository)
+                self.metrics.incr('prs_deferred', len(deferred), repository=str(repository))
+            yield (changed_prs, deferred)
+
+    def stale_filters(self, repository, pr_id, updated_at, now):
+        """The repository's filters whose result for a PR isn't known: the
+        PR or the filter changed since it was recorded, or time may have
+        changed it."""
+        key = (repository.owner, repository.name, pr_id)
+        return [pr_filter for pr_filter in repository.pr_filters
+                if self.results.get(key, updated_at, pr_filter, now) is None]
+
+    def evaluate(self, repository, changed_prs, deferred, shard=None):
+        """Apply the filters to a page of changed PRs, then write out what
+        was learned about them. With a ``shard``, its lease is checked
+        before each PR."""
+        deferred = set(pr.id for pr in deferred)
         for changed in changed_prs:
-            for pr_filter in self.pr_filters:
-                pr_filter.apply(changed)
-                self.update_pr(changed.id, changed.updated_at)
+            if changed.id in deferred:
+                continue
+            if shard is not None:
+                self.leases.hold(shard)
+            now = datetime.datetime.now()
+            key = (repository.owner, repository.name, changed.id)
+            stale = self.stale_filters(repository, changed.id, changed.updated_at, now)
+            for pr_filter in repository.pr_filters:
+                if pr_filter not in stale:
+                    self.metrics.incr('filter_results_reused', filter=pr_filter.name)
+                    continue
+                matched = pr_filter.apply(changed)
+                self.results.set(key, changed.updated_at, pr_filter, matched,
+                                 valid_until=pr_filter.next_due(changed, now))
+            self.state.set(key, changed.updated_at, next_due=repository.next_due(changed, now))
+        self.state.flush()
+        self.results.flush()
+        self.comments.flush()
+        # So are the responses fetched for the page, and those ahead of it
+        self.http_cache.flush()
+        self.comments.release(changed_prs)
+        for changed in changed_prs:
+            changed.forget()
+
+    def run_repository(self, repository, shard=None):
+        """Stream the repository's PRs from the listing, through comment
+        prefetching, to evaluation. Each stage runs in a thread of its own,
+        at most meta.pipeline_depth pages ahead of the next, so network waits
+        overlap evaluation and memory doesn't grow with the repository."""
+        examined = 0
+        if self.stopping.is_set():
+            return examined
+        # Backfilled listings with PRs left for the next run, whose cursors
+        # mustn't move past them
+        held = set()
+        try:
+            pages = background(self.get_prs2(repository, shard), self.pipeline_depth)
+            for (changed_prs, deferred) in background(self.prefetch(repository, pages),
+                                                      self.pipeline_depth):
+                self.evaluate(repository, changed_prs, deferred, shard)
+                examined += len(changed_prs)
+                if deferred:
+                    held.add(changed_prs.listing)
+                if changed_prs.listing is not None and changed_prs.listing not in held:
+                    self.cursors.advance(repository.owner, repository.name,
+                                         changed_prs.listing, changed_prs.cursor)
+                # Every page is stored as it is evaluated; a backfill
+                # continues from here next run
+                if self.stopping.is_set():
+                    log.info("Stopping %s before the end of its listing", repository)
+                    break
+        except RateLimited as exc:
+            # Whatever wasn't stored yet is examined again next run
+            log.warning("Stopping %s: %s", repository, exc)
+
+        log.info("Examined %s PRs in %s", examined, repository)
+        self.metrics.incr('prs_examined', examined, repository=str(repository))
+        return examined
+
+    def run_shards(self, since):
+        """Sweep, one lease at a time, every shard which no worker sharing
+        the database has swept since ``since``. Returns how many PRs had
+        changed."""
+        examined = 0
+        while not self.stopping.is_set():
+            shard = self.leases.claim(int(since))
+            if shard is None:
+                break
+            log.info("Sweeping shard %s of %s", shard, self.shards)
+            # Other workers may have swept this shard's PRs since we looked
+            self.state.flush()
+            self.state.load()
+            self.results.flush()
+            self.results.load()
+            self.comments.flush()
+            self.comments.load()
+            if self.shard_by == 'pr':
+                work = [(repository, shard) for repository in self.repositories]
+            else:
+                work = [(repository, shard) for repository in self.repositories
+                        if self.shard_of(repository, None) == shard]
+            try:
+                examined += sum(concurrent_map(
+                    lambda item: self.run_repository(*item), work, self.repository_pool))
+            except LeaseLost as exc:
+                log.warning("Abandoning shard %s: %s", shard, exc)
+                continue
+            except Exception:
+                # Let another worker have a go straight away
+                self.leases.release(shard)
+                raise
+            self.leases.release(shard, swept=True)
+        return examined
+
+    def find_repository(self, owner, name):
+        for repository in self.repositories:
+            if (repository.owner, repository.name) == (owner, name):
+                return repository
+
+    def handle_event(self, event, payload):
+        """Apply a ``pull_request`` or ``issue_comment`` webhook payload and
+        evaluate the one PR it concerns. Returns the names of the filters
+        which matched. PRs which are no longer open are forgotten instead.
+
+        While a sweep is under way the payload is only stored, and the PR is
+        evaluated once the sweep is done; None is returned then, so GitHub
+        isn't kept waiting for the sweep.
+
+        The PR is not marked as seen, so the next sweep still reconciles it
+        against the API and catches up on any deliveries that were missed.
+        """
+        repository = self.find_repository(payload['repository']['owner']['login'],
+                                          payload['repository']['name'])
+        if repository is None:
+            return []
+
+        if event == 'pull_request':
+            key = (repository.owner, repository.name, payload['pull_request']['number'])
+            if payload['action'] == 'closed' or payload['pull_request']['state'] != 'open':
+                # Closed and merged PRs are no longer swept
+                self.open_prs.pop(key, None)
+                return []
+            pr = PullRequest(pr_resources.PullRequest(payload['pull_request']),
+                             repo_owner=repository.owner, repo_name=repository.name,
+                             fields=repository.fields)
+            self.open_prs[key] = pr
+        elif event == 'issue_comment' and 'pull_request' in payload['issue'] \
+                and payload['action'] in ('created', 'edited', 'deleted'):
+            key = (repository.owner, repository.name, payload['issue']['number'])
+            if key not in self.open_prs:
+                self.open_prs[key] = PullRequest(
+                    self.client.pull_request(repository.owner, repository.name, key[2]),
+                    repo_owner=repository.owner, repo_name=repository.name,
+                    fields=repository.fields)
+            pr = self.open_prs[key]
+        else:
+            return []
+
+        if event == 'issue_comment' and payload['action'] == 'deleted':
+            # A retracted vote no longer counts
+            self.comments.remove(pr, payload['comment']['id'])
+        elif event == 'issue_comment':
+            self.comments.ingest(pr, Comment.from_payload(payload['comment']))
+
+        if not self.run_lock.acquire(False):
+            self.comments.flush()
+            with self.db_lock:
+                self.delayed_events.add(key)
+            log.info("Evaluating %s once the sweep under way is done", pr)
+            return None
+        try:
+            return self.evaluate_event(repository, pr)
+        finally:
+            self.run_lock.release()
+
+    def evaluate_event(self, repository, pr):
+        """Apply ``repository``'s filters to ``pr`` after a webhook delivery
+        changed it. Returns the names of the filters which matched."""
+        with self.run_lock:
+            if self.ledger_unreconciled:
+                self.reconcile_ledger()
+            # Another worker sweeping the PR's shard will see the change
+            shard = self.shard_of(repository, pr.number) if self.shards > 1 else None
+            if shard is not None and not self.leases.acquire(shard):
+                log.info("Leaving %s to the worker holding shard %s", pr, shard)
+                return []
+            # The listed record may remember a tally from before this event
+            pr.forget()
+            try:
+                matched = [pr_filter.name for pr_filter in repository.pr_filters
+                           if pr_filter.apply(pr)]
+            except RateLimited as exc:
+                log.warning("Leaving %s for the next sweep: %s", pr, exc)
+                return []
+            finally:
+                pr.forget()
+                self.comments.flush()
+                # The next delivery lists them again, answered from the cache
+                # unless something changed
+                self.comments.release([pr])
+                if shard is not None:
+                    self.leases.release(shard)
+            self.executor.drain(self.stopping)
+            return matched
+
+    def evaluate_delayed_events(self):
+        """Evaluate the PRs whose webhooks arrived during a sweep. Returns
+        the names of the filters each matched, by ``(owner, repo, number)``."""
+        results = {}
+        with self.run_lock:
+            with self.db_lock:
+                keys = sorted(self.delayed_events)
+                self.delayed_events.clear()
+            for key in keys:
+                repository = self.find_repository(*key[:2])
+                pr = self.open_prs.get(key)
+                # Closed while waiting
+                if repository is None or pr is None:
+                    continue
+                results[key] = self.evaluate_event(repository, pr)
+        return results
+
+    def reconcile_ledger(self):
+        """Record the actions whose comments the bot has already posted on
+        open PRs, so they aren't repeated. Lists every open PR and its
+        comments, so it is meant to be run once, when the ledger is new.
+        Returns how many entries were added."""
+        recorded = 0
+        with self.run_lock:
+            self.comments.start_run()
+            try:
+                for repository in self.repositories:
+                    prs = self.list_open_prs(repository)
+                    self.comments.prefetch(prs, pool=self.fetch_pool)
+
+                    entries = []
+                    for pr in prs:
+                        posted = [comment for comment in self.comments.comments(pr)
+                                  if comment.user['login'] == self.config['meta']['bot_user']]
+                        for pr_filter in repository.pr_filters:
+                            entries.extend(pr_filter.reconcile(pr, posted))
+                    recorded += self.ledger.record(*entries)
+            finally:
+                self.comments.flush()
+            with self.db_lock, self.conn:
+                self.conn.execute(
+                    """INSERT OR REPLACE INTO maintenance(task, last_run)
+                    VALUES ('reconcile_ledger', ?)""", (int(time.time()), ))
+            self.ledger_unreconciled = False
+        log.info("Recorded %s earlier actions in the ledger", recorded)
+        return recorded
+
+    def list_open_prs(self, repository):
+        return [self.pull_request(repository, resource)
+                for page in self.client.pull_requests(repository.owner, repository.name)
+                for resource in page]
+
+    def record_snapshot(self, path):
+        """Save every open PR in every repository, with its votes, to
+        ``path`` for :meth:`what_if`. Comments already stored are only
+        fetched again if they changed."""
+        snapshot = Snapshot()
+        with self.run_lock:
+            self.comments.start_run()
+            try:
+                for repository in self.repositories:
+                    prs = self.list_open_prs(repository)
+                    self.comments.prefetch(prs, pool=self.fetch_pool)
+                    for pr in prs:
+                        snapshot.add(pr, self.comments.comments(pr))
+            finally:
+                self.comments.flush()
+        snapshot.save(path)
+        log.info("Recorded %s PRs to %s", len(snapshot), path)
+        return snapshot
+
+    def what_if(self, snapshot):
+        """Which PRs in ``snapshot`` each configured filter matches, without
+        executing any actions. Returns ``[(repository, filter name, [PR
+        numbers])]``."""
+        report = []
+        for repository in self.repositories:
+            tally = snapshot.tally(repository.vote_counter.approvers)
+            for pr_filter in repository.pr_filters:
+                rows = snapshot.matches(pr_filter, repository.owner, repository.name, tally)
+                report.append((str(repository), pr_filter.name,
+                               [snapshot.prs['number'][row] for row in rows]))
+        return report
+
+    def run(self):
+        """Examine every repository once. Returns how many PRs had changed."""
+        with self.run_lock:
+            if self.ledger_unreconciled:
+                self.reconcile_ledger()
+            try:
+                return self._run()
+            finally:
+                self.evaluate_delayed_events()
+
+    def _run(self):
+        started = time.time()
+        self.scheduler.start_run()
+        self.comments.start_run()
+        self.http_cache.start_run()
+        try:
+            if self.shards > 1:
+                return self.run_shards(started)
+            return sum(concurrent_map(self.run_repository, self.repositories,
+                                      self.repository_pool))
+        finally:
+            # Whatever was evaluated is written back, even if a later PR
+            # blew up.
+            flushed = self.state.flush()
+            self.comments.flush()
+            log.info("Stored state for %s PRs", flushed)
+            executed = self.executor.drain(self.stopping)
+            log.info("Executed %s queued actions", executed)
+            self.http_cache.flush()
+            self.maintain()
+            log.info("HTTP cache: %s hits, %s misses",
+                     self.http_cache.hits, self.http_cache.misses)
+            self.scheduler.report()
+            self.export_metrics(started)
+
+    def export_metrics(self, started):
+        """Write the metrics collected since the last run finished, webhook
+        evaluations in between included, to the files named in meta."""
+        finished = time.time()
+        self.metrics.set('run_seconds', finished - started)
+        self.metrics.set('run_finished_timestamp_seconds', finished)
+        try:
+            self.run_metrics = self.metrics.export(
+                json_path=self.config['meta'].get('metrics_json'),
+                textfile_path=self.config['meta'].get('metrics_textfile'))
+        except (IOError, OSError):
+            log.exception("Could not write metrics")
+
+    def run_forever(self, min_interval=60, max_interval=900):
+        """Call :meth:`run` until :meth:`stop` is called.
+
+        While PRs keep changing the next run starts ``min_interval`` seconds
+        after the last one. Each quiet run doubles the wait, up to
+        ``max_interval``. When the rate limit is used up, the wait stretches
+        to the limit's reset.
+        """
+        interval = min_interval
+        while not self.stopping.is_set():
+            try:
+                examined = self.run()
+            except Exception:
+                log.exception("Run failed")
+                examined = 0
+
+            if examined:
+                interval = min_interval
+            else:
+                interval = min(interval * 2, max_interval)
+            reset_at = self.scheduler.budget().reset_at
+            if not self.scheduler.can_read() and reset_at:
+                interval = max(interval, reset_at - time.time())
+
+            log.info("Next run in %d seconds", interval)
+            self.stopping.wait(interval)
+
+        self.close()
+
+    def stop(self):
+        """Ask :meth:`run_forever` to return once the current run is done."""
+        log.info("Shutting down")
+        self.stopping.set()
+
+    def close(self):
+        # Stop taking deliveries, then let an evaluation under way finish
+        if self.webhook_server is not None:
+            self.webhook_server.shutdown()
+            self.webhook_server.server_close()
+            self.webhook_server = None
+        with self.run_lock:
+            self.state.flush()
+            self.results.flush()
+            self.comments.flush()
+            self.http_cache.flush()
+            self.conn.close()
+        for pool in (self.repository_pool, self.fetch_pool):
+            if pool is not None:
+                pool.close()
+                pool.join()
 
 
 if __name__ == '__main__':
-    bot = MergerBot('conf.yaml')
-    bot.run()
+    parser = argparse.ArgumentParser(description='Comment on GitHub PRs which match configured rules')
+    parser.add_argument('--config', default='conf.yaml', help='Path to the configuration file')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, polling at the intervals set in the meta section')
+    parser.add_argument('--webhook', action='store_true',
+                        help='Keep running, evaluating PRs as webhooks arrive and '
+                        'only sweeping every webhook.sweep_interval seconds')
+    parser.add_argument('--reconcile-ledger', action='store_true',
+                        help='First record the comments the bot has already posted on open '
+                        'PRs in the action ledger, so they are not posted again')
+    parser.add_argument('--record-snapshot', metavar='PATH',
+                        help='Save every open PR and its votes to PATH, then exit')
+    parser.add_argument('--what-if', metavar='PATH',
+                        help='Report which PRs in the snapshot at PATH the configured '
+                        'filters match, without executing actions, then exit')
+    parser.add_argument('--worker', metavar='NAME',
+                        help='Name this worker holds shard leases under, when meta.shards '
+                        'splits the work between several (default: host:pid)')
+    args = parser.parse_args()
+
+    bot = MergerBot(args.config, worker=args.worker)
+    if args.record_snapshot:
+        bot.record_snapshot(args.record_snapshot)
+        raise SystemExit()
+    if args.what_if:
+        snapshot = Snapshot.load(args.what_if)
+        for (repository, name, numbers) in bot.what_if(snapshot):
+            print("%s [%s]: %s of %s PRs match" % (repository, name, len(numbers), len(snapshot)))
+            if numbers:
+                print("    " + ", ".join('#%s' % number for number in numbers))
+        raise SystemExit()
+    if args.reconcile_ledger:
+        bot.reconcile_ledger()
+    if args.daemon or args.webhook:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: bot.stop())
+
+        min_interval = int(bot.config['meta'].get('poll_min_interval', 60))
+        max_interval = int(bot.config['meta'].get('poll_max_interval', 900))
+        if args.webhook:
+            webhook = bot.config.get('webhook', {})
+            server = WebhookServer(
+                (webhook.get('host', '127.0.0.1'), int(webhook.get('port', 8080))),
+                bot, webhook.get('secret') or os.environ.get('WEBHOOK_SECRET'))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            bot.webhook_server = server
+            min_interval = max_interval = int(webhook.get('sweep_interval', 3600))
+
+        bot.run_forever(min_interval=min_interval, max_interval=max_interval)
+    else:
+        bot.run()
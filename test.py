@@ -1,9 +1,52 @@
 # -*- coding: utf-8 -*-
 import unittest
-from process import PullRequestFilter
+import process
+from process import PullRequestFilter, StateStore, ResponseCache, CachingAdapter, \
+    CommentStore, MergerBot, PullRequest, VoteCounter, Scheduler, RateLimited, \
+    WebhookServer, Metrics, Snapshot, LeaseStore, LeaseLost, FilterResults, ActionQueue
 import datetime
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import yaml
+import requests
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
 import parsedatetime
 from attrdict import AttrDict
+from fakegithub import FakeGitHub, make_dataset
+
+
+def make_bot(config=None, meta=None, worker=None, **repository):
+    """MergerBot for a throwaway config and database. ``meta`` is added to
+    the default meta section."""
+    tmp = tempfile.mkdtemp()
+    if config is None:
+        config = {
+            'repository': {
+                'owner': 'o',
+                'name': 'r',
+                'pr_approvers': [],
+                'filters': [],
+            }
+        }
+        config['repository'].update(repository)
+    config.setdefault('meta', {
+        'database_path': os.path.join(tmp, 'cache.sqlite'),
+        'bot_user': 'bot',
+    })
+    config['meta'].update(meta or {})
+    conf_path = os.path.join(tmp, 'conf.yaml')
+    with open(conf_path, 'w') as handle:
+        yaml.safe_dump(config, handle)
+    return MergerBot(conf_path, worker=worker)
 
 
 class TestPullRequestFilter(unittest.TestCase):
@@ -70,11 +113,7 @@ class TestPullRequestFilter(unittest.TestCase):
     def test_check_to_branch(self):
         prf = PullRequestFilter("test_filter", [], [])
         fakepr = AttrDict({
-            'resource': {
-                'base': {
-                    'ref': 'dev'
-                }
-            }
+            'base': 'dev'
         })
 
         self.assertTrue(
@@ -135,11 +174,7 @@ class TestPullRequestFilter(unittest.TestCase):
         fakepr = AttrDict({
             u'title': u'[PROCEDURES] Testing…',
             u'state': u'open',
-            u'resource': {
-                u'base': {
-                    u'ref': u'dev'
-                }
-            },
+            u'base': u'dev',
             u'created_at': self._get_dt_from_relative("1 day ago")
         })
 
@@ -298,11 +333,7 @@ class TestPullRequestFilter(unittest.TestCase):
         fakepr = AttrDict({
             u'title': u'[PROCEDURES] Testing…',
             u'state': u'open',
-            u'resource': {
-                u'base': {
-                    u'ref': u'dev'
-                }
-            },
+            u'base': u'dev',
             u'created_at': self._get_dt_from_relative("1 day ago")
         })
 
@@ -332,3 +363,1323 @@ class TestPullRequestFilter(unittest.TestCase):
                 ('older_than__not', '2 days ago'),
             ])
         )
+
+
+class TestStateStore(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = make_bot().conn
+        self.conn.execute("INSERT INTO pr_data(owner, repo, pr_id, updated_at) "
+                          "VALUES ('o', 'r', 1, 1442282820)")
+        self.conn.commit()
+
+    def test_load(self):
+        store = StateStore(self.conn)
+        self.assertEquals(store.get(('o', 'r', 1)), datetime.datetime(2015, 9, 15, 2, 7))
+        self.assertEquals(store.get(('o', 'other', 1)), None)
+
+    def test_only_changed_rows_are_flushed(self):
+        store = StateStore(self.conn)
+        store.set(('o', 'r', 1), datetime.datetime(2015, 9, 15, 2, 7))
+        store.set(('o', 'r', 2), datetime.datetime(2015, 9, 16, 0, 0))
+        store.set(('o', 'r', 3), datetime.datetime(2015, 9, 17, 0, 0))
+
+        self.assertEquals(store.dirty, set([('o', 'r', 2), ('o', 'r', 3)]))
+        self.assertEquals(store.flush(), 2)
+        self.assertEquals(store.flush(), 0)
+
+        reloaded = StateStore(self.conn)
+        self.assertEquals(reloaded.get(('o', 'r', 3)), datetime.datetime(2015, 9, 17, 0, 0))
+
+    def test_legacy_table_is_migrated(self):
+        bot = make_bot()
+        path = os.path.join(tempfile.mkdtemp(), 'legacy.sqlite')
+        legacy = sqlite3.connect(path)
+        legacy.execute("CREATE TABLE pr_data(pr_id INTEGER PRIMARY KEY, updated_at TEXT)")
+        legacy.execute("INSERT INTO pr_data VALUES (1, '2015-09-15T02:07:00.Z')")
+        legacy.commit()
+        legacy.close()
+
+        bot.create_db(database_name=path)
+        self.assertEquals(bot.state.get(('o', 'r', 1)), datetime.datetime(2015, 9, 15, 2, 7))
+
+    def test_legacy_table_is_migrated_to_lone_repository(self):
+        rule = {'name': 'votes', 'conditions': [{'plus__ge': 1}], 'actions': []}
+        bot = make_bot({'defaults': {'pr_approvers': ['a'], 'filters': [rule]},
+                        'repositories': [{'owner': 'o', 'name': 'one'}]})
+        path = os.path.join(tempfile.mkdtemp(), 'legacy.sqlite')
+        legacy = sqlite3.connect(path)
+        legacy.execute("CREATE TABLE pr_data(pr_id INTEGER PRIMARY KEY, updated_at TEXT)")
+        legacy.execute("INSERT INTO pr_data VALUES (1, '2015-09-15T02:07:00.Z')")
+        legacy.commit()
+        legacy.close()
+
+        bot.create_db(database_name=path)
+        self.assertEquals(bot.state.get(('o', 'one', 1)), datetime.datetime(2015, 9, 15, 2, 7))
+
+    def test_unversioned_schema_is_migrated(self):
+        path = os.path.join(tempfile.mkdtemp(), 'v1.sqlite')
+        old = sqlite3.connect(path)
+        old.executescript("""
+            CREATE TABLE pr_data(owner TEXT, repo TEXT, pr_id INTEGER, updated_at TEXT,
+                                 next_due TEXT, PRIMARY KEY (owner, repo, pr_id));
+            CREATE TABLE pr_comments(comment_id INTEGER PRIMARY KEY, pr_id INTEGER,
+                                     login TEXT, body TEXT, updated_at TEXT);
+            INSERT INTO pr_data VALUES ('o', 'r', 1, '2015-09-15T02:07:00.Z',
+                                        '2015-09-22T02:07:00.Z');
+            INSERT INTO pr_comments VALUES (5, 1, 'a', ':+1:', '2015-09-15T03:00:00.Z');
+            INSERT INTO pr_comments VALUES (6, 99, 'a', ':+1:', '2015-09-15T03:00:00.Z');
+        """)
+        old.close()
+
+        bot = make_bot()
+        bot.create_db(database_name=path)
+        self.assertEquals(bot.conn.execute("PRAGMA user_version").fetchone()[0],
+                          MergerBot.SCHEMA_VERSION)
+        self.assertEquals(bot.conn.execute("SELECT * FROM pr_data").fetchall(),
+                          [('o', 'r', 1, 1442282820, 1442887620)])
+        self.assertEquals(bot.state.next_due[('o', 'r', 1)], datetime.datetime(2015, 9, 22, 2, 7))
+        # The comment on a PR of unknown repository is gone
+        pr = PullRequest(AttrDict({'id': 1, 'number': 2}), repo_owner='o', repo_name='r')
+        self.assertEquals([(c.id, c.updated_at) for c in bot.comments.stored(pr)],
+                          [(5, datetime.datetime(2015, 9, 15, 3))])
+
+    def test_filter_results(self):
+        prf = PullRequestFilter("test_filter", [{'older_than': '1 week ago'}], [])
+        key = ('o', 'r', 1)
+        updated_at = datetime.datetime(2015, 9, 15)
+        now = datetime.datetime(2015, 9, 16)
+        results = FilterResults(self.conn)
+        results.set(key, updated_at, prf, False, valid_until=datetime.datetime(2015, 9, 22))
+        results.flush()
+
+        results = FilterResults(self.conn)
+        self.assertEquals(results.get(key, updated_at, prf, now), False)
+        # The PR changed, time ran out, or the filter was edited
+        self.assertEquals(results.get(key, now, prf, now), None)
+        self.assertEquals(results.get(key, updated_at, prf, datetime.datetime(2015, 9, 22)), None)
+        edited = PullRequestFilter("test_filter", [{'older_than': '2 weeks ago'}], [])
+        self.assertEquals(results.get(key, updated_at, edited, now), None)
+
+        results.prune('o', 'r', [1])
+        self.assertEquals(FilterResults(self.conn).rows, {})
+
+    def test_prune(self):
+        store = StateStore(self.conn)
+        now = datetime.datetime(2015, 9, 20)
+        for key in (('o', 'r', 2), ('o', 'r', 3), ('o', 'x', 3)):
+            store.set(key, now)
+        store.flush()
+
+        self.assertEquals(sorted(store.prune('o', 'r', set([2]))), [1, 3])
+        self.assertEquals(sorted(store.rows), [('o', 'r', 2), ('o', 'x', 3)])
+        self.assertEquals(sorted(StateStore(self.conn).rows), [('o', 'r', 2), ('o', 'x', 3)])
+
+    def test_maintain(self):
+        bot = make_bot()
+        self.assertTrue(bot.maintain(now=1000))
+        self.assertFalse(bot.maintain(now=1000 + 3600))
+        self.assertTrue(bot.maintain(now=1000 + 8 * 24 * 3600))
+
+    def test_due(self):
+        store = StateStore(self.conn)
+        now = datetime.datetime(2015, 9, 20)
+        store.set(('o', 'r', 2), now, next_due=now - datetime.timedelta(hours=1))
+        store.set(('o', 'r', 3), now, next_due=now + datetime.timedelta(hours=1))
+        store.set(('o', 'x', 4), now, next_due=now - datetime.timedelta(hours=1))
+        store.flush()
+
+        self.assertEquals(store.due('o', 'r', now), set([2]))
+        self.assertEquals(store.due('o', 'r', now + datetime.timedelta(days=1)), set([2, 3]))
+
+
+class ETagHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = b'[{"id": 1}]'
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Link', '<http://example.com/?page=2>; rel="next"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCachingAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ETagHandler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute("CREATE TABLE http_cache(url TEXT PRIMARY KEY, etag TEXT, "
+                          "last_modified TEXT, link TEXT, body BLOB)")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _session(self, cache):
+        session = requests.session()
+        session.mount(self.url, CachingAdapter(cache))
+        return session
+
+    def test_not_modified_served_from_cache(self):
+        cache = ResponseCache(self.conn)
+        first = self._session(cache).get(self.url + '?page=1&access_token=secret')
+        cache.flush()
+
+        cache = ResponseCache(self.conn)
+        second = self._session(cache).get(self.url + '?page=1&access_token=secret')
+
+        self.assertEquals(second.status_code, 200)
+        self.assertEquals(second.content, first.content)
+        self.assertEquals(second.headers['link'], first.headers['link'])
+        self.assertEquals((cache.hits, cache.misses), (1, 0))
+
+    def test_cache_key_drops_token(self):
+        self.assertEquals(
+            CachingAdapter.cache_key('https://api.github.com/x?access_token=abc&page=2'),
+            'https://api.github.com/x?page=2'
+        )
+        self.assertEquals(
+            CachingAdapter.cache_key('https://api.github.com/x?page=2&access_token=abc'),
+            'https://api.github.com/x?page=2'
+        )
+
+
+class TestCommentStore(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = make_bot().conn
+        self.requests = []
+        self.remote = [
+            AttrDict({'id': 1, 'body': ':+1:', 'user': {'login': 'a'},
+                      'updated_at': datetime.datetime(2015, 1, 1)}),
+            AttrDict({'id': 2, 'body': ':-1:', 'user': {'login': 'b'},
+                      'updated_at': datetime.datetime(2015, 1, 2)}),
+        ]
+
+    def _fetch(self, number, user=None, repo=None, since=None):
+        self.requests.append(since)
+        return [[c for c in self.remote if since is None or c.updated_at >= since]]
+
+    def test_sync_follows_remote(self):
+        pr = AttrDict({'id': 10, 'number': 5, 'repo_owner': 'o', 'repo_name': 'r'})
+        store = CommentStore(self.conn, fetch=self._fetch)
+        self.assertEquals([c.id for c in store.comments(pr)], [1, 2])
+        # Served from memory for the rest of the run
+        store.comments(pr)
+        self.assertEquals(self.requests, [None])
+        store.flush()
+
+        # The :-1: was deleted and another comment added
+        self.remote[1:] = [AttrDict({'id': 3, 'body': 'lgtm', 'user': {'login': 'c'},
+                                     'updated_at': datetime.datetime(2015, 1, 3)})]
+        store = CommentStore(self.conn, fetch=self._fetch)
+        comments = store.comments(pr)
+        self.assertEquals([c.id for c in comments], [1, 3])
+        self.assertEquals(comments[1].user['login'], 'c')
+        self.assertEquals(self.requests, [None, None])
+        store.flush()
+        self.assertEquals(
+            self.conn.execute("SELECT comment_id FROM pr_comments ORDER BY comment_id").fetchall(),
+            [(1, ), (3, )])
+
+    def test_checks_share_store(self):
+        pr = PullRequest(AttrDict({'id': 10, 'number': 5}), repo_owner='o', repo_name='r')
+        store = CommentStore(self.conn, fetch=self._fetch)
+        prf = PullRequestFilter("test_filter", [], [], committer_group=['a', 'b'],
+                                comment_store=store)
+        self.assertEquals(prf.check_plus(pr), 1)
+        self.assertEquals(prf.check_minus(pr), 1)
+        self.assertEquals(len(self.requests), 1)
+
+    def test_concurrent_prefetch_matches_serial(self):
+        prs = [PullRequest(AttrDict({'id': 10 + i, 'number': i}), repo_owner='o', repo_name='r')
+               for i in range(6)]
+        serial = CommentStore(self.conn, fetch=self._fetch)
+        expected = [[c.id for c in serial.comments(pr)] for pr in prs]
+
+        store = CommentStore(self.conn, fetch=self._fetch)
+        pool = process.worker_pool(4)
+        self.addCleanup(pool.close)
+        store.prefetch(prs, pool=pool)
+        del self.requests[:]
+        self.assertEquals([[c.id for c in store.comments(pr)] for pr in prs], expected)
+        # Everything was served from the prefetch
+        self.assertEquals(self.requests, [])
+
+
+class TestFilterPlan(unittest.TestCase):
+
+    def test_free_conditions_first(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [
+                {'plus__ge': 2},
+                {'state': 'open'},
+                {'minus__eq': 0},
+                {'to_branch__not': 'dev'},
+            ],
+            []
+        )
+
+        self.assertEquals(
+            [key for (key, value, predicate) in prf.plan],
+            ['state', 'to_branch__not', 'plus__ge', 'minus__eq']
+        )
+
+    def test_rejected_before_comments_are_needed(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [{'plus__ge': 2}, {'to_branch__not': 'dev'}],
+            []
+        )
+        # No comment store and no memo_comments: reaching plus__ge would fail
+        fakepr = AttrDict({'base': 'dev'})
+        self.assertEquals(prf.apply(fakepr), None)
+
+    def test_needs_comments(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [{'plus__ge': 2}, {'to_branch__not': 'dev'}],
+            []
+        )
+        self.assertFalse(prf.needs_comments(AttrDict({'base': 'dev'})))
+        self.assertTrue(prf.needs_comments(AttrDict({'base': 'master'})))
+
+        prf = PullRequestFilter("test_filter", [{'state': 'open'}], [])
+        self.assertFalse(prf.needs_comments(AttrDict({'state': 'open'})))
+
+    def test_next_due(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [{'title_contains': '[PROCEDURES]'}, {'older_than': '168 hours ago'}, {'plus__ge': 5}],
+            []
+        )
+        now = datetime.datetime(2015, 9, 20)
+        fakepr = AttrDict({
+            'title': '[PROCEDURES] Testing',
+            'created_at': now - datetime.timedelta(hours=100),
+        })
+        self.assertEquals(prf.next_due(fakepr, now), now + datetime.timedelta(hours=68))
+
+        # Already old enough: nothing left to wait for
+        fakepr['created_at'] = now - datetime.timedelta(hours=200)
+        self.assertEquals(prf.next_due(fakepr, now), None)
+
+        # Could never match anyway
+        fakepr['title'] = 'Testing'
+        fakepr['created_at'] = now - datetime.timedelta(hours=100)
+        self.assertEquals(prf.next_due(fakepr, now), None)
+
+    def test_invalid_conditions_fail_at_load(self):
+        for conditions in (
+            [{'nonsense': 1}],
+            [{'plus': 1}],
+            [{'plus__about': 1}],
+            [{'state__eq': 'open'}],
+            [{'older_than': 'qwerty'}],
+        ):
+            self.assertRaises(ValueError, PullRequestFilter, "test_filter", conditions, [])
+
+
+class TestVoteCounter(unittest.TestCase):
+
+    def test_tally(self):
+        counter = VoteCounter(['a', 'b'])
+        comments = [[
+            AttrDict({'body': ':+1:', 'user': {'login': 'a'}}),
+            AttrDict({'body': 'asdf\n-1\n', 'user': {'login': 'b'}}),
+            AttrDict({'body': ':+1: :-1:', 'user': {'login': 'b'}}),
+            AttrDict({'body': ':+1:', 'user': {'login': 'c'}}),
+            AttrDict({'body': 'lgtm', 'user': {'login': 'a'}}),
+        ]]
+
+        tally = counter.tally(comments)
+        self.assertEquals((tally.plus, tally.minus), (2, 2))
+        self.assertEquals(tally.per_user, {'a': (1, 0), 'b': (1, 2)})
+
+    def test_filters_share_one_tally(self):
+        counter = VoteCounter(['a'])
+        filters = [
+            PullRequestFilter(name, [{'plus__ge': 1}], [], vote_counter=counter)
+            for name in ('first', 'second')
+        ]
+        pr = PullRequest(AttrDict({'id': 10, 'number': 5, 'title': 't', 'user': {'login': 'x'}}))
+        pr.memo_comments = [[AttrDict({'body': ':+1:', 'user': {'login': 'a'}})]]
+
+        self.assertTrue(filters[0].apply(pr))
+        tally = pr.memo_tally
+        self.assertTrue(filters[1].apply(pr))
+        self.assertTrue(pr.memo_tally is tally)
+
+
+class TestPullRequest(unittest.TestCase):
+
+    def test_projection(self):
+        prf = PullRequestFilter('votes', [{'to_branch': 'dev'}, {'plus__ge': 1}],
+                                [{'action': 'comment', 'comment': 'Ready {author}'}])
+        self.assertEquals(prf.fields, set(['base', 'user']))
+
+        resource = AttrDict({'id': 7, 'number': 1, 'title': 't', 'state': 'open',
+                             'base': {'ref': 'dev'}, 'user': {'login': 'x'}, 'body': 'b'})
+        pr = PullRequest(resource, repo_owner='o', repo_name='r', fields=prf.fields)
+        self.assertEquals((pr.id, pr.number, pr.base, pr.title, pr.state), (7, 1, 'dev', None, None))
+        self.assertEquals(str(pr), '<#1 by @x (https://github.com/o/r/pull/1)>')
+        self.assertFalse(hasattr(pr, '__dict__'))
+        # Every record of a user shares one
+        self.assertTrue(pr.user is PullRequest(resource).user)
+        pr.memo_comments = [[]]
+        self.assertEquals(prf.apply(pr), None)
+
+
+class TestRepositories(unittest.TestCase):
+
+    def test_defaults_and_overrides(self):
+        rule = {'name': 'votes', 'conditions': [{'plus__ge': 1}], 'actions': []}
+        bot = make_bot({
+            'defaults': {'pr_approvers': ['a'], 'filters': [rule]},
+            'repositories': [
+                {'owner': 'o', 'name': 'one'},
+                {'owner': 'o', 'name': 'two', 'pr_approvers': ['b']},
+            ],
+        })
+
+        (one, two) = bot.repositories
+        self.assertEquals(str(one), 'o/one')
+        self.assertEquals(one.vote_counter.approvers, frozenset(['a']))
+        self.assertEquals(two.vote_counter.approvers, frozenset(['b']))
+        self.assertEquals(two.pr_filters[0].repo_name, 'two')
+        self.assertEquals(len(one.pr_filters), 1)
+
+    def test_listings_are_narrowed(self):
+        def queries(*conditions):
+            return make_bot(filters=[
+                {'name': 'f%s' % index, 'conditions': condition, 'actions': []}
+                for (index, condition) in enumerate(conditions)
+            ]).repositories[0].queries
+
+        self.assertEquals(queries({'to_branch': 'dev', 'plus__ge': 1}, {'to_branch': 'master'}),
+                          [{'base': 'dev'}, {'base': 'master'}])
+        self.assertEquals(queries({'to_branch': 'dev'}, {'state': 'closed'}), [{'base': 'dev'}])
+        self.assertEquals(queries({'to_branch': 'dev'}, {'to_branch__not': 'dev'}), [{}])
+        self.assertEquals(queries({'title_contains': 'Fix'}), [{}])
+        self.assertEquals(queries({'state__not': 'open'}), [])
+
+
+class TestScheduler(unittest.TestCase):
+
+    def _response(self, status_code=200, **headers):
+        response = requests.models.Response()
+        response.status_code = status_code
+        response.headers.update(dict(
+            (key.replace('_', '-'), str(value)) for (key, value) in headers.items()))
+        return response
+
+    def test_budget_from_headers(self):
+        scheduler = Scheduler(reserve=10)
+        self.assertTrue(scheduler.can_read())
+
+        scheduler.observe(self._response(x_ratelimit_remaining=11, x_ratelimit_limit=5000))
+        self.assertTrue(scheduler.can_read())
+        scheduler.observe(self._response(x_ratelimit_remaining=10, x_ratelimit_limit=5000))
+        self.assertFalse(scheduler.can_read())
+        self.assertTrue(scheduler.can_write())
+        self.assertEquals(scheduler.used, 2)
+
+        # Conditional hits are free
+        scheduler.observe(self._response(304, x_ratelimit_remaining=10))
+        self.assertEquals(scheduler.used, 2)
+
+    def test_budget_returns_after_reset(self):
+        scheduler = Scheduler(reserve=10)
+        reset_at = int(time.time()) + 60
+        scheduler.observe(self._response(x_ratelimit_remaining=10, x_ratelimit_reset=reset_at))
+        self.assertFalse(scheduler.can_read())
+        scheduler.budget().reset_at = time.time() - 1
+        self.assertTrue(scheduler.can_read())
+        self.assertEquals(scheduler.budget().remaining, None)
+
+    def test_graphql_quota_is_separate(self):
+        scheduler = Scheduler(reserve=10, read_resource='graphql')
+        scheduler.observe(self._response(x_ratelimit_remaining=10,
+                                         x_ratelimit_resource='graphql'))
+        self.assertFalse(scheduler.can_read())
+        self.assertTrue(scheduler.can_write())
+
+        scheduler.observe(self._response(403, x_ratelimit_remaining=0,
+                                         x_ratelimit_resource='core'))
+        self.assertFalse(scheduler.can_write())
+        scheduler.observe(self._response(x_ratelimit_remaining=11,
+                                         x_ratelimit_resource='graphql'))
+        self.assertTrue(scheduler.can_read())
+
+    def test_secondary_limit_blocks(self):
+        scheduler = Scheduler()
+        self.assertTrue(scheduler.observe(self._response(403, retry_after=60)))
+        self.assertFalse(scheduler.can_read())
+        self.assertFalse(scheduler.can_write())
+        self.assertFalse(scheduler.observe(self._response(404)))
+
+    def test_closest_prs_scheduled_first(self):
+        store = CommentStore(make_bot().conn, fetch=None)
+        counter = VoteCounter(['a', 'b'])
+        prf = PullRequestFilter("test_filter", [{'plus__ge': 2}], [], vote_counter=counter)
+        prs = [PullRequest(AttrDict({'id': i, 'number': i})) for i in range(3)]
+        for (pr, votes) in zip(prs, (0, 2, 1)):
+            for voter in ['a', 'b'][:votes]:
+                store.add(pr, AttrDict({'id': pr.id * 10 + votes, 'body': ':+1:',
+                                        'user': {'login': voter},
+                                        'updated_at': datetime.datetime(2015, 1, 1)}))
+
+        scheduler = Scheduler(reserve=1)
+        scheduler.observe(self._response(x_ratelimit_remaining=3))
+        (now, later) = scheduler.schedule(prs, [prf], store, counter)
+        self.assertEquals([pr.id for pr in now], [1, 2])
+        self.assertEquals([pr.id for pr in later], [0])
+        self.assertEquals(scheduler.deferred, 1)
+
+    def test_shortfall(self):
+        prf = PullRequestFilter("test_filter", [{'plus__ge': 5}, {'minus__eq': 0},
+                                                {'state': 'open'}], [])
+        tally = VoteCounter([]).tally([])._replace(plus=3, minus=1)
+        self.assertEquals(prf.shortfall(AttrDict({'state': 'open'}), tally), 3)
+        self.assertEquals(prf.shortfall(AttrDict({'state': 'closed'}), tally), None)
+
+    def test_comment_needs_write_budget(self):
+        scheduler = Scheduler()
+        scheduler.observe(self._response(x_ratelimit_remaining=0))
+        prf = PullRequestFilter("test_filter", [], [], scheduler=scheduler)
+        fakepr = AttrDict({'user': {'login': 'x'}, 'memo_comments': [[]]})
+        self.assertRaises(RateLimited, prf.execute, fakepr,
+                          {'action': 'comment', 'comment': 'hi {author}'})
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_adaptive_interval(self):
+        bot = make_bot()
+        examined = [3, 0, 0, 0, 0, 2, 0]
+        waits = []
+
+        def run():
+            if len(examined) == 1:
+                bot.stop()
+            return examined.pop(0)
+
+        bot.run = run
+        bot.stopping.wait = waits.append
+        bot.run_forever(min_interval=10, max_interval=50)
+
+        self.assertEquals(waits, [10, 20, 40, 50, 50, 10, 20])
+        # The database is closed on the way out
+        self.assertRaises(sqlite3.ProgrammingError, bot.conn.execute, "SELECT 1")
+
+
+PULL_REQUEST_PAYLOAD = {
+    'action': 'opened',
+    'number': 7,
+    'pull_request': {
+        'id': 34778301,
+        'number': 7,
+        'state': 'open',
+        'title': '[PROCEDURES] Update the release process',
+        'user': {'login': 'someone'},
+        'body': '',
+        'url': 'https://api.github.com/repos/o/r/pulls/7',
+        'created_at': '2015-09-14T16:13:25Z',
+        'updated_at': '2015-09-14T16:13:25Z',
+        'base': {'ref': 'dev'},
+    },
+    'repository': {'name': 'r', 'owner': {'login': 'o'}},
+}
+
+ISSUE_COMMENT_PAYLOAD = {
+    'action': 'created',
+    'issue': {
+        'number': 7,
+        'pull_request': {'url': 'https://api.github.com/repos/o/r/pulls/7'},
+    },
+    'comment': {
+        'id': 140280771,
+        'user': {'login': 'a'},
+        'body': ':+1:',
+        'created_at': '2015-09-15T02:07:00Z',
+        'updated_at': '2015-09-15T02:07:00Z',
+    },
+    'repository': {'name': 'r', 'owner': {'login': 'o'}},
+}
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = make_bot(
+            pr_approvers=['a', 'b'],
+            filters=[{
+                'name': 'votes',
+                'conditions': [{'title_contains': '[PROCEDURES]'}, {'plus__ge': 1},
+                               {'minus__eq': 0}],
+                'actions': [],
+            }],
+        )
+        self.remote = []
+        self.bot.comments.fetch = self._fetch
+        self.server = WebhookServer(('127.0.0.1', 0), self.bot, 'sekrit')
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%s/' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _fetch(self, number, user=None, repo=None, since=None):
+        return [self.remote]
+
+    def _comment(self, payload):
+        # Listed by the API once it was delivered
+        self.remote.append(AttrDict(dict(payload['comment'],
+                                         updated_at=datetime.datetime(2015, 9, 15, 2, 7))))
+        return self._post('issue_comment', payload)
+
+    def _post(self, event, payload, secret='sekrit'):
+        body = json.dumps(payload).encode('utf-8')
+        signature = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        return requests.post(self.url, data=body, headers={
+            'X-GitHub-Event': event,
+            'X-Hub-Signature-256': 'sha256=' + signature,
+        })
+
+    def test_events_are_evaluated(self):
+        response = self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        self.assertEquals(response.json(), {'matched': []})
+
+        response = self._comment(ISSUE_COMMENT_PAYLOAD)
+        self.assertEquals(response.json(), {'matched': ['votes']})
+
+        # The comment was stored, but the PR is left for the next sweep
+        self.assertEquals(
+            self.bot.conn.execute("SELECT login FROM pr_comments").fetchall(), [('a', )])
+        self.assertEquals(self.bot.state.rows, {})
+
+    def test_stored_comments_are_listed_first(self):
+        self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        # A veto the bot never stored
+        self.remote.append(AttrDict({'id': 140280770, 'body': ':-1:', 'user': {'login': 'b'},
+                                     'updated_at': datetime.datetime(2015, 9, 15, 1)}))
+        response = self._comment(ISSUE_COMMENT_PAYLOAD)
+        self.assertEquals(response.json(), {'matched': []})
+        self.assertEquals(
+            self.bot.conn.execute("SELECT login FROM pr_comments ORDER BY login").fetchall(),
+            [('a', ), ('b', )])
+
+    def test_deliveries_during_a_sweep_are_delayed(self):
+        self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        with self.bot.run_lock:
+            response = self._comment(ISSUE_COMMENT_PAYLOAD)
+            self.assertEquals(response.status_code, 202)
+            # Stored straight away
+            self.assertEquals(
+                self.bot.conn.execute("SELECT login FROM pr_comments").fetchall(), [('a', )])
+        self.assertEquals(self.bot.evaluate_delayed_events(), {('o', 'r', 7): ['votes']})
+        self.assertEquals(self.bot.delayed_events, set())
+
+    def test_deleted_comments_stop_counting(self):
+        self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        self.assertEquals(self._comment(ISSUE_COMMENT_PAYLOAD).json(), {'matched': ['votes']})
+        del self.remote[:]
+        response = self._post('issue_comment', dict(ISSUE_COMMENT_PAYLOAD, action='deleted'))
+        self.assertEquals(response.json(), {'matched': []})
+        self.assertEquals(self.bot.conn.execute("SELECT login FROM pr_comments").fetchall(), [])
+
+    def test_closed_prs_are_not_evaluated(self):
+        self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        payload = dict(PULL_REQUEST_PAYLOAD, action='closed',
+                       pull_request=dict(PULL_REQUEST_PAYLOAD['pull_request'], state='closed'))
+        response = self._post('pull_request', payload)
+        self.assertEquals(response.json(), {'matched': []})
+        self.assertEquals(self.bot.open_prs, {})
+
+    def test_close_stops_deliveries(self):
+        self._post('pull_request', PULL_REQUEST_PAYLOAD)
+        self.bot.webhook_server = self.server
+        self.bot.close()
+        self.assertEquals(self.bot.webhook_server, None)
+        self.assertRaises(requests.ConnectionError, self._post,
+                          'pull_request', PULL_REQUEST_PAYLOAD)
+        self.assertRaises(sqlite3.ProgrammingError, self.bot.conn.execute, "SELECT 1")
+
+    def test_bad_signature_rejected(self):
+        response = self._post('pull_request', PULL_REQUEST_PAYLOAD, secret='guess')
+        self.assertEquals(response.status_code, 403)
+
+    def test_issue_comments_ignored(self):
+        payload = dict(ISSUE_COMMENT_PAYLOAD, issue={'number': 7})
+        response = self._post('issue_comment', payload)
+        self.assertEquals(response.json(), {'matched': []})
+
+
+class TestFakeGitHub(unittest.TestCase):
+
+    def setUp(self):
+        (pulls, comments) = make_dataset(150, 3, ['a', 'b'], seed=1)
+        self.server = FakeGitHub(pulls, comments).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_bot(self, meta=None, worker=None, **repository):
+        meta = dict({'api_url': self.server.url, 'retry_backoff': 0,
+                     'write_interval': 0}, **(meta or {}))
+        return make_bot(meta=meta, worker=worker, **repository)
+
+    def test_cold_then_warm_run(self):
+        bot = self.make_bot(pr_approvers=['a', 'b'], filters=[{
+            'name': 'votes',
+            'conditions': {'title_contains__not': '[WIP]', 'plus__ge': 2},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }])
+        # Responses are written out as pages are evaluated, not held until
+        # the end of the run
+        evaluate = bot.evaluate
+        held = []
+
+        def evaluate_page(*args, **kwargs):
+            evaluate(*args, **kwargs)
+            held.append(len(bot.http_cache.pending))
+        bot.evaluate = evaluate_page
+        self.assertEquals(bot.run(), 150)
+        self.assertEquals(len(held), 2)
+        self.assertTrue(max(held) < 100)
+        self.assertEquals(held[-1], 0)
+        commented = self.server.calls['create_comment']
+        self.assertTrue(commented)
+        # The listing comes in pages of 100
+        self.assertEquals(self.server.calls['pulls'], 2)
+        # Evaluated pages' comments are written out and forgotten
+        self.assertEquals(bot.comments.memo, {})
+        self.assertEquals(bot.state.dirty, set())
+
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 0)
+        self.assertEquals(self.server.calls, {'pulls': 2, 'not_modified': 2})
+
+    def test_reconcile_ledger(self):
+        filters = [{
+            'name': 'votes',
+            'conditions': {'plus__ge': 2},
+            'actions': [{'action': 'comment', 'comment': '[PROCEDURES] {author} is ready'}],
+        }]
+        self.make_bot(pr_approvers=['a', 'b'], filters=filters).run()
+        commented = self.server.calls['create_comment']
+        self.assertTrue(commented)
+
+        # A bot which has lost its database learns what it already posted
+        bot = self.make_bot(pr_approvers=['a', 'b'], filters=filters)
+        self.assertEquals(bot.reconcile_ledger(), commented)
+        self.assertEquals(bot.reconcile_ledger(), 0)
+        bot.run()
+        self.assertEquals(self.server.calls['create_comment'], commented)
+
+    def test_listings_are_narrowed(self):
+        filters = [{
+            'name': 'bugfix',
+            'conditions': [{'to_branch': 'master'}, {'state': 'open'}, {'plus__ge': 1}],
+            'actions': [{'action': 'comment', 'comment': 'Bugfix ready'}],
+        }, {
+            'name': 'release',
+            'conditions': [{'to_branch': 'release_15.07'}, {'title_contains': 'Fix'}],
+            'actions': [{'action': 'comment', 'comment': 'Release fix'}],
+        }]
+        bot = self.make_bot(pr_approvers=['a'], filters=filters)
+        report = bot.what_if(Snapshot.load(self._snapshot(bot)))
+        self.server.calls.clear()
+
+        examined = bot.run()
+        # Only PRs into master and release_15.07 are paged in
+        targets = [pr for pr in self.server.pulls if pr['base']['ref'] != 'dev']
+        self.assertEquals(examined, len(targets))
+        self.assertEquals(self.server.calls['pulls'], 2)
+        for (repository, name, numbers) in report:
+            text = 'Bugfix ready' if name == 'bugfix' else 'Release fix'
+            commented = [number for (number, comments) in sorted(self.server.comments.items())
+                         if any(comment['body'] == text for comment in comments)]
+            self.assertTrue(numbers)
+            self.assertEquals(numbers, commented)
+
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 0)
+        self.assertEquals(self.server.calls, {'pulls': 2, 'not_modified': 2})
+
+    def test_edited_filters_are_evaluated_again(self):
+        votes = {
+            'name': 'votes',
+            'conditions': {'plus__ge': 2},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }
+        titles = {
+            'name': 'titles',
+            'conditions': {'title_contains': 'Fix'},
+            'actions': [{'action': 'comment', 'comment': 'A fix'}],
+        }
+        meta = {'database_path': os.path.join(tempfile.mkdtemp(), 'cache.sqlite')}
+        self.assertEquals(self.make_bot(meta=meta, pr_approvers=['a', 'b'],
+                                        filters=[votes, titles]).run(), 150)
+
+        # Only the edited filter is applied again, and it needs no comments
+        titles = dict(titles, conditions={'title_contains': 'Feature'})
+        bot = self.make_bot(meta=meta, pr_approvers=['a', 'b'], filters=[votes, titles])
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 150)
+        reused = dict((sample['labels']['filter'], sample['value'])
+                      for sample in bot.run_metrics['filter_results_reused'])
+        self.assertEquals(reused, {'votes': 150})
+        self.assertEquals(self.server.calls['comments'], 0)
+        features = [pr for pr in self.server.pulls if 'Feature' in pr['title']]
+        self.assertEquals(self.server.calls['create_comment'], len(features))
+
+        self.assertEquals(bot.run(), 0)
+
+    def _snapshot(self, bot):
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json.gz')
+        bot.record_snapshot(path)
+        return path
+
+    def test_what_if_agrees_with_a_run(self):
+        bot = self.make_bot(pr_approvers=['a'], filters=[{
+            'name': 'bugfix',
+            'conditions': [{'plus__ge': 1}, {'minus__eq': 0}, {'to_branch__not': 'dev'}],
+            'actions': [{'action': 'comment', 'comment': 'Bugfix ready'}],
+        }, {
+            'name': 'old',
+            'conditions': [{'title_contains': 'Fix'}, {'older_than': '30 days ago'}],
+            'actions': [{'action': 'comment', 'comment': 'Old fix'}],
+        }])
+        path = os.path.join(tempfile.mkdtemp(), 'snapshot.json.gz')
+        bot.record_snapshot(path)
+        snapshot = Snapshot.load(path)
+        self.assertEquals(len(snapshot), 150)
+        report = bot.what_if(snapshot)
+        self.assertEquals(self.server.calls['create_comment'], 0)
+
+        bot.run()
+        for (repository, name, numbers) in report:
+            self.assertEquals(repository, 'o/r')
+            text = 'Bugfix ready' if name == 'bugfix' else 'Old fix'
+            commented = [number for (number, comments) in sorted(self.server.comments.items())
+                         if any(comment['body'] == text for comment in comments)]
+            self.assertTrue(numbers)
+            self.assertEquals(numbers, commented)
+
+    def test_closed_prs_are_pruned(self):
+        bot = self.make_bot(pr_approvers=['a', 'b'], filters=[{
+            'name': 'votes',
+            'conditions': {'plus__ge': 1},
+            'actions': [],
+        }])
+        bot.run()
+        closed = [pr for pr in self.server.pulls[:10] if self.server.comments[pr['number']]]
+        for pr in closed:
+            pr['state'] = 'closed'
+        bot.run()
+
+        closed_ids = set(pr['id'] for pr in closed)
+        self.assertEquals(len(bot.state.rows), 150 - len(closed))
+        stored = set(pr_id for (pr_id, ) in bot.conn.execute("SELECT pr_id FROM pr_comments"))
+        self.assertTrue(stored)
+        self.assertFalse(stored & closed_ids)
+        urls = [url for (url, ) in bot.conn.execute("SELECT url FROM http_cache")]
+        self.assertFalse([url for url in urls for pr in closed
+                          if '/issues/%s/' % pr['number'] in url])
+
+    def test_run_metrics(self):
+        bot = self.make_bot(pr_approvers=['a', 'b'], filters=[{
+            'name': 'votes',
+            'conditions': {'plus__ge': 2},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }])
+        bot.run()
+        metrics = dict((name, dict((tuple(sorted(sample['labels'].items())), sample['value'])
+                                   for sample in samples))
+                       for (name, samples) in bot.run_metrics.items())
+
+        self.assertEquals(metrics['api_pages'][(('endpoint', 'pulls'), )], 2)
+        self.assertEquals(metrics['api_pages'][(('endpoint', 'issues/:number/comments'), )], 150)
+        self.assertEquals(metrics['prs_examined'][(('repository', 'o/r'), )], 150)
+        self.assertEquals(
+            metrics['condition_evaluations'][(('condition', 'plus__ge'), ('filter', 'votes'))], 150)
+        matches = metrics['filter_matches'][(('filter', 'votes'), )]
+        self.assertEquals(
+            metrics['actions_executed'][(('action', 'comment'), ('filter', 'votes'))], matches)
+        self.assertEquals(self.server.calls['create_comment'], matches)
+        self.assertTrue(metrics['sqlite_seconds'][(('operation', 'commit'), )] > 0)
+
+    def test_graphql_backend(self):
+        filters = [{
+            'name': 'votes',
+            'conditions': {'title_contains__not': '[WIP]', 'plus__ge': 2},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }]
+        self.make_bot(pr_approvers=['a', 'b'], filters=filters).run()
+        rest_commented = sorted(number for (number, comments) in self.server.comments.items()
+                                if any(comment['body'] == 'Ready' for comment in comments))
+        self.assertTrue(rest_commented)
+
+        (pulls, comments) = make_dataset(150, 3, ['a', 'b'], seed=1)
+        server = FakeGitHub(pulls, comments).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        bot = make_bot({
+            'meta': {
+                'database_path': os.path.join(tempfile.mkdtemp(), 'cache.sqlite'),
+                'bot_user': 'bot',
+                'api': 'graphql',
+                'api_url': server.url,
+                'graphql_url': server.url + 'graphql',
+                'graphql_page_size': 50,
+            },
+            'repository': {'owner': 'o', 'name': 'r', 'pr_approvers': ['a', 'b'],
+                           'filters': filters},
+        })
+        self.assertEquals(bot.run(), 150)
+        graphql_commented = sorted(number for (number, comments) in server.comments.items()
+                                   if any(comment['body'] == 'Ready' for comment in comments))
+        self.assertEquals(graphql_commented, rest_commented)
+        # Three pages of PRs, every comment included
+        self.assertEquals(server.calls['graphql'], 3)
+        self.assertEquals(server.calls['comments'], 0)
+        self.assertEquals(server.calls['pulls'], 0)
+
+        # A PR with more comments than a listing includes asks for them
+        comments[1].extend({'id': 10 ** 6 + index, 'user': {'login': 'contributor'},
+                            'body': 'Ping', 'created_at': pulls[0]['updated_at'],
+                            'updated_at': pulls[0]['updated_at']} for index in range(150))
+        pulls[0]['updated_at'] = '2099-01-01T00:00:00Z'
+        server.calls.clear()
+        self.assertEquals(bot.run(), 1)
+        # Three pages of PRs and two of the PR's comments
+        self.assertEquals(server.calls['graphql'], 5)
+        self.assertEquals(len(bot.comments.stored(bot.list_open_prs(bot.repositories[0])[0])),
+                          len(comments[1]))
+
+    def test_retries(self):
+        bot = self.make_bot(pr_approvers=['a', 'b'], filters=[
+            {'name': 'votes', 'conditions': {'plus__ge': 1}, 'actions': []}])
+        self.server.failures = [502, 403, 503]
+        self.assertEquals(bot.run(), 150)
+        self.assertEquals(self.server.calls['failed'], 3)
+        retries = dict((sample['labels']['status'], sample['value'])
+                       for sample in bot.run_metrics['api_retries'])
+        self.assertEquals(retries, {502: 1, 403: 1, 503: 1})
+
+        # Writes aren't repeated after a server error, nor is anything
+        # after the last retry
+        self.server.failures = [502]
+        self.assertRaises(Exception, bot.client.create_comment, 'o', 'r', 1, 'Hi')
+        self.server.failures = [502] * 4
+        self.assertRaises(Exception, bot.client.pull_request, 'o', 'r', 1)
+        self.assertEquals(self.server.calls['failed'], 8)
+
+    def test_failed_action_is_retried(self):
+        self._check_failed_action_is_retried({}, 'comments')
+
+    def test_failed_action_is_retried_over_graphql(self):
+        self._check_failed_action_is_retried(
+            {'api': 'graphql', 'graphql_url': self.server.url + 'graphql'}, 'graphql')
+
+    def test_graphql_comments_since_unparsed_time(self):
+        client = process.GraphQLClient(url=self.server.url + 'graphql')
+        nodes = [{'databaseId': index, 'body': 'Ready', 'author': {'login': 'bot'},
+                  'updatedAt': '2015-09-15T0%d:00:00Z' % index} for index in (1, 2)]
+        client.query = lambda *args, **variables: {'repository': {'pullRequest': {'comments': {
+            'nodes': nodes, 'pageInfo': {'hasNextPage': False, 'endCursor': None}}}}}
+        pages = client.comments(1, user='o', repo='r',
+                                since=datetime.datetime(2015, 9, 15, 2))
+        self.assertEquals([(comment.id, comment.updated_at) for page in pages for comment in page],
+                          [(2, datetime.datetime(2015, 9, 15, 2))])
+
+    def _check_failed_action_is_retried(self, meta, listing):
+        bot = self.make_bot(filters=[{
+            'name': 'open',
+            'conditions': {'state': 'open'},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }], meta=dict(meta, action_backoff=0))
+        pr = bot.list_open_prs(bot.repositories[0])[0]
+        self.assertTrue(bot.repositories[0].pr_filters[0].apply(pr))
+        # Queued, not posted
+        self.assertEquals(self.server.calls['create_comment'], 0)
+        self.assertEquals(bot.action_queue.counts(), (1, 0))
+
+        # The comment is created, but the answer is lost
+        self.server.calls.clear()
+        self.server.failures = [502]
+        self.assertEquals(bot.executor.drain(), 1)
+        # The second attempt finds the comment instead of posting another
+        self.assertEquals(self.server.calls['failed'], 1)
+        self.assertEquals(self.server.calls['create_comment'], 1)
+        self.assertEquals(self.server.calls[listing], 1)
+        self.assertTrue(bot.ledger.executed(
+            bot.repositories[0].pr_filters[0].ledger_key(pr, {'action': 'comment',
+                                                              'comment': 'Ready'})))
+        self.assertEquals([comment['body'] for comment in self.server.comments[pr.number]
+                           if comment['body'] == 'Ready'], ['Ready'])
+        self.assertEquals(bot.action_queue.counts(), (0, 0))
+        self.assertEquals(bot.metrics.samples[
+            ('actions_failed', (('action', 'comment'), ('filter', 'open')))], 1)
+
+        # Matching again doesn't queue it again
+        self.assertTrue(bot.repositories[0].pr_filters[0].apply(pr))
+        self.assertEquals(bot.action_queue.counts(), (0, 0))
+
+    def test_upgraded_database_does_not_repeat_comments(self):
+        # A database of the bot before it had an action ledger, which has
+        # already commented on the first PR
+        path = os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+        legacy = sqlite3.connect(path)
+        legacy.execute("CREATE TABLE pr_data(pr_id INTEGER PRIMARY KEY, updated_at TEXT)")
+        legacy.execute("INSERT INTO pr_data VALUES (?, '2015-09-15T02:07:00.Z')",
+                       (self.server.pulls[0]['id'], ))
+        legacy.commit()
+        legacy.close()
+        self.server.comments.setdefault(1, []).append({
+            'id': 10 ** 8, 'user': {'login': 'bot'}, 'body': 'Ready @a',
+            'created_at': '2015-09-15T02:07:00Z', 'updated_at': '2015-09-15T02:07:00Z'})
+        self.server.pulls[0]['user'] = {'login': 'a'}
+
+        bot = self.make_bot(meta={'database_path': path}, filters=[{
+            'name': 'open',
+            'conditions': {'state': 'open'},
+            'actions': [{'action': 'comment', 'comment': 'Ready {author}'}],
+        }])
+        self.assertTrue(bot.ledger_unreconciled)
+        self.assertEquals(bot.run(), 150)
+        self.assertEquals([comment['body'] for comment in self.server.comments[1]
+                           if comment['user']['login'] == 'bot'], ['Ready @a'])
+        self.assertEquals(self.server.calls['create_comment'], 149)
+
+        # Only once
+        self.assertFalse(self.make_bot(meta={'database_path': path}).ledger_unreconciled)
+
+    def test_runs_resume_after_rate_limit_reset(self):
+        bot = self.make_bot(filters=[
+            {'name': 'open', 'conditions': {'state': 'open'}, 'actions': []}])
+        self.assertEquals(bot.run(), 150)
+        # The rate limit runs out after the first page
+        self.server.remaining = 1
+        self.server.pulls[0]['updated_at'] = '2030-01-01T00:00:00Z'
+        self.assertEquals(bot.run(), 1)
+        self.assertFalse(bot.scheduler.can_read())
+
+        # The limit resets, and another PR changes
+        self.server.remaining = self.server.rate_limit
+        bot.scheduler.budget().reset_at = time.time() - 1
+        self.server.pulls[-1]['updated_at'] = '2030-01-01T00:00:00Z'
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 1)
+        self.assertEquals(self.server.calls['pulls'], 2)
+
+    def test_backfill_resumes(self):
+        bot = self.make_bot(filters=[
+            {'name': 'open', 'conditions': {'state': 'open'}, 'actions': []}])
+        # The second page of the listing keeps failing
+        self.server.failures = [None] + [502] * 4
+        self.assertRaises(Exception, bot.run)
+        listing = json.dumps({'shard': None})
+        self.assertEquals(bot.cursors.resume('o', 'r', listing), (True, '1:100'))
+        # The first page was evaluated and stored
+        self.assertEquals(len(bot.state.rows), 100)
+
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 50)
+        # The first page again, unchanged, then the second
+        self.assertEquals(self.server.calls['pulls'], 2)
+        self.assertEquals(self.server.calls['not_modified'], 1)
+        self.assertEquals(bot.cursors.resume('o', 'r', listing), (False, None))
+
+        # Once complete, sweeps list everything again
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 0)
+        self.assertEquals(self.server.calls['pulls'], 2)
+
+    def test_backfill_resumes_after_prs_close(self):
+        bot = self.make_bot(filters=[
+            {'name': 'open', 'conditions': {'state': 'open'}, 'actions': []}])
+        self.server.failures = [None] + [502] * 4
+        self.assertRaises(Exception, bot.run)
+        # PRs on the first page close, moving later ones onto it
+        for pr in self.server.pulls[:10]:
+            pr['state'] = 'closed'
+
+        self.server.calls.clear()
+        self.assertEquals(bot.run(), 50)
+        # The first page now ends with the PRs which were on the second
+        self.assertEquals(self.server.calls['pulls'], 2)
+        self.assertEquals(self.server.calls['not_modified'], 0)
+        self.assertEquals(len(bot.state.rows), 150)
+
+    def test_pools_are_kept_between_runs(self):
+        bot = self.make_bot(meta={'concurrency': 4}, pr_approvers=['a', 'b'], filters=[{
+            'name': 'votes', 'conditions': {'plus__ge': 1}, 'actions': []}])
+        self.addCleanup(bot.close)
+        pools = (bot.repository_pool, bot.fetch_pool)
+        # One repository needs no pool of its own
+        self.assertEquals(pools[0], None)
+        self.assertEquals(bot.run(), 150)
+        self.server.pulls[0]['updated_at'] = '2030-01-01T00:00:00Z'
+        self.assertEquals(bot.run(), 1)
+        self.assertTrue(bot.fetch_pool is pools[1])
+
+    def test_stop_during_backfill(self):
+        bot = self.make_bot(filters=[
+            {'name': 'open', 'conditions': {'state': 'open'}, 'actions': []}])
+        evaluate = bot.evaluate
+
+        def evaluate_then_stop(*args, **kwargs):
+            evaluate(*args, **kwargs)
+            bot.stop()
+        bot.evaluate = evaluate_then_stop
+        self.assertEquals(bot.run(), 100)
+        listing = json.dumps({'shard': None})
+        self.assertEquals(bot.cursors.resume('o', 'r', listing), (True, '1:100'))
+        self.assertEquals(len(bot.state.rows), 100)
+
+        bot.stopping.clear()
+        bot.evaluate = evaluate
+        self.assertEquals(bot.run(), 50)
+        self.assertEquals(bot.cursors.resume('o', 'r', listing), (False, None))
+
+    def test_client_is_lazy(self):
+        bot = self.make_bot()
+        self.assertEquals(bot.client._services, None)
+        self.assertEquals(bot.client.pull_request('o', 'r', 3).number, 3)
+        # One session, whose adapter keeps the connection open
+        (pulls, comments) = bot.client.services()
+        self.assertTrue(pulls._client.requester is comments._client.requester)
+        self.assertEquals(self.server.calls['pull'], 1)
+
+    def test_sharded_workers(self):
+        filters = [{
+            'name': 'votes',
+            'conditions': {'plus__ge': 1},
+            'actions': [{'action': 'comment', 'comment': 'Ready'}],
+        }]
+        meta = {'database_path': os.path.join(tempfile.mkdtemp(), 'cache.sqlite'),
+                'shards': 8, 'shard_by': 'pr'}
+        bots = [self.make_bot(meta=meta, worker='worker-%s' % worker,
+                              pr_approvers=['a', 'b'], filters=filters)
+                for worker in range(3)]
+        # A crashed worker's lease runs out
+        bots[0].conn.execute("UPDATE leases SET worker = 'gone', expires_at = 1 WHERE shard = 5")
+        bots[0].conn.commit()
+
+        examined = []
+        threads = [threading.Thread(target=lambda bot=bot: examined.append(bot.run()))
+                   for bot in bots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every PR was examined by exactly one worker, and commented on once
+        self.assertEquals(sum(examined), 150)
+        ready = [len([comment for comment in comments if comment['body'] == 'Ready'])
+                 for comments in self.server.comments.values()]
+        self.assertEquals(max(ready), 1)
+        self.assertEquals(self.server.calls['create_comment'], sum(ready))
+        leases = bots[0].conn.execute("SELECT worker, swept_at FROM leases").fetchall()
+        self.assertEquals(len(leases), 8)
+        self.assertFalse([lease for lease in leases if lease[0] is not None or not lease[1]])
+
+        # Shards swept since a worker's run started aren't swept again
+        self.assertEquals(bots[1].run_shards(since=0), 0)
+
+    def test_unknown_api(self):
+        self.assertRaises(ValueError, make_bot, {'meta': {'api': 'soap'}, 'repository': {
+            'owner': 'o', 'name': 'r', 'pr_approvers': [], 'filters': []}})
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_bounded(self):
+        produced = []
+
+        def numbers():
+            for number in range(10):
+                produced.append(number)
+                yield number
+
+        items = process.background(numbers(), maxsize=2)
+        self.assertEquals(next(items), 0)
+        time.sleep(0.1)
+        # One item handed over, two queued and one waiting to be
+        self.assertEquals(len(produced), 4)
+        self.assertEquals(list(items), list(range(1, 10)))
+
+    def test_exceptions_reach_the_caller(self):
+        def failing():
+            yield 1
+            raise RateLimited("out of budget")
+
+        items = process.background(failing())
+        self.assertEquals(next(items), 1)
+        self.assertRaises(RateLimited, next, items)
+
+    def test_closing_stops_the_producer(self):
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    yield 1
+            finally:
+                closed.set()
+
+        items = process.background(endless())
+        next(items)
+        items.close()
+        self.assertTrue(closed.is_set())
+
+
+class TestLeaseStore(unittest.TestCase):
+
+    def setUp(self):
+        path = make_bot().conn.execute("PRAGMA database_list").fetchone()[2]
+        # Two workers, each with its own connection to the shared database
+        self.a = LeaseStore(sqlite3.connect(path), 'a', 2, duration=100)
+        self.b = LeaseStore(sqlite3.connect(path), 'b', 2, duration=100)
+
+    def test_claim(self):
+        self.assertEquals(self.a.claim(since=1000, now=1000), 0)
+        self.assertEquals(self.b.claim(since=1000, now=1000), 1)
+        self.assertEquals(self.b.claim(since=1000, now=1000), None)
+
+        self.b.release(1, swept=True, now=1010)
+        self.assertEquals(self.a.claim(since=1000, now=1010), None)
+        # Until the next run
+        self.assertEquals(self.a.claim(since=1020, now=1020), 1)
+
+    def test_expired_lease_is_taken_over(self):
+        self.assertEquals(self.a.claim(since=1000, now=1000), 0)
+        self.assertFalse(self.b.acquire(0, now=1099))
+        self.assertTrue(self.b.acquire(0, now=1100))
+        self.assertRaises(LeaseLost, self.a.hold, 0, now=1100)
+
+    def test_hold_renews(self):
+        self.assertTrue(self.a.acquire(0, now=1000))
+        self.a.hold(0, now=1040)
+        self.assertEquals(self.a.expires[0], 1100)
+        self.a.hold(0, now=1060)
+        self.assertEquals(self.a.expires[0], 1160)
+        self.assertFalse(self.b.acquire(0, now=1120))
+        # A lease which ran out but wasn't taken over is still good
+        self.a.hold(0, now=1200)
+        self.assertEquals(self.a.expires[0], 1300)
+
+
+class TestActionLedger(unittest.TestCase):
+
+    def test_duplicate_check_is_a_lookup(self):
+        bot = make_bot()
+        action = {'action': 'comment', 'comment': 'Ready {author}'}
+        prf = PullRequestFilter('votes', [], [action], ledger=bot.ledger)
+        pr = PullRequest(AttrDict({'id': 7, 'number': 1, 'title': 't',
+                                   'user': {'login': 'x'}}), repo_owner='o', repo_name='r')
+        key = prf.ledger_key(pr, action)
+
+        self.assertFalse(prf.needs_comments(pr))
+        self.assertFalse(bot.ledger.executed(key))
+        self.assertEquals(bot.ledger.record((key, 3, None)), 1)
+        self.assertEquals(bot.ledger.record((key, 4, None)), 0)
+        self.assertTrue(bot.ledger.executed(key))
+        # No comments are listed to find out
+        self.assertEquals(prf.execute(pr, action), None)
+
+        edited = dict(action, comment='Ready to merge {author}')
+        self.assertNotEquals(prf.ledger_key(pr, edited), key)
+
+
+class TestActionQueue(unittest.TestCase):
+
+    def test_attempts(self):
+        bot = make_bot()
+        queue = ActionQueue(bot.conn, claim_seconds=60, max_attempts=2)
+        key = ('o', 'r', 7, 'votes', 'abc')
+        action = {'action': 'comment', 'comment': 'Ready'}
+        self.assertTrue(queue.put(key, 1, action, 'Ready', now=100))
+        self.assertFalse(queue.put(key, 1, action, 'Ready', now=100))
+        self.assertEquals(queue.take(now=99), None)
+
+        self.assertEquals(queue.take(now=100), (key, 1, action, 'Ready', 1, 100))
+        # Claimed, so no other worker takes it
+        self.assertEquals(queue.take(now=159), None)
+        queue.retry(key, 130, error='Server Error')
+        # Put back without being tried
+        self.assertEquals(queue.take(now=130)[4], 2)
+        queue.retry(key, 130, attempted=False)
+        self.assertEquals(queue.take(now=130)[4], 2)
+        queue.retry(key, 200, error='Server Error')
+
+        # Given up on until it is queued again
+        self.assertEquals(queue.take(now=300), None)
+        self.assertEquals(queue.counts(), (0, 1))
+        self.assertTrue(queue.put(key, 1, action, 'Ready', now=300))
+        self.assertEquals(queue.take(now=300)[4], 1)
+        queue.done(key)
+        self.assertEquals(queue.counts(), (0, 0))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_export(self):
+        metrics = Metrics()
+        metrics.incr('api_requests', endpoint='pulls', method='GET', status=200)
+        metrics.incr('api_requests', endpoint='pulls', method='GET', status=200)
+        metrics.incr('filter_matches', filter='Say "hi"')
+        metrics.set('run_seconds', 1.5)
+
+        tmp = tempfile.mkdtemp()
+        summary = metrics.export(json_path=os.path.join(tmp, 'metrics.json'),
+                                 textfile_path=os.path.join(tmp, 'p4.prom'))
+
+        self.assertEquals(summary['run_seconds'], [{'labels': {}, 'value': 1.5}])
+        with open(os.path.join(tmp, 'metrics.json')) as handle:
+            self.assertEquals(json.load(handle), json.loads(json.dumps(summary)))
+        with open(os.path.join(tmp, 'p4.prom')) as handle:
+            self.assertEquals(handle.read().splitlines(), [
+                '# HELP p4_run_seconds Wall time of the run',
+                '# TYPE p4_run_seconds gauge',
+                'p4_run_seconds 1.5',
+                '# HELP p4_api_requests API requests, by endpoint, method and status',
+                '# TYPE p4_api_requests gauge',
+                'p4_api_requests{endpoint="pulls",method="GET",status="200"} 2.0',
+                '# HELP p4_filter_matches PRs which passed every condition, by filter',
+                '# TYPE p4_filter_matches gauge',
+                'p4_filter_matches{filter="Say \\"hi\\""} 1.0',
+            ])
+        # Every export starts afresh
+        self.assertEquals(metrics.export(), {})
+
+    def test_endpoint(self):
+        self.assertEquals(
+            CachingAdapter.endpoint('https://api.github.com/repos/o/r/issues/12/comments?page=2'),
+            'issues/:number/comments')
+        self.assertEquals(
+            CachingAdapter.endpoint('https://api.github.com/repos/o/r/pulls'), 'pulls')